@@ -0,0 +1,190 @@
+"""Offline benchmark of the client and server hot paths.
+
+Starts benchmarks/fake_pluto.py in a separate process and points every
+https:// request of a Client at it, then times each stage:
+
+    boot, lineup fetch, cached lineup, full and incremental EPG refresh,
+    programme rendering (read_epg_data), guide writing (create_xml_file)
+    per country and merged, and the playlist, channels and EPG routes,
+    including filtered playlist and guide subsets.
+
+Run from the repository root; nothing touches the network:
+
+    python benchmarks/bench_client.py --channels 400 --hours 36 --latency 20
+    python benchmarks/bench_client.py --countries local,us_east,ca,uk --memory
+    python benchmarks/bench_client.py --fixtures path/to/recorded/responses
+
+--memory also reports the peak Python heap of every stage (tracemalloc),
+which makes the timings of that run slower. Work files go to a temporary
+directory that is removed afterwards.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse, math, os, resource, subprocess, sys, tempfile, time, tracemalloc
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import pluto
+
+
+class LocalAdapter(HTTPAdapter):
+    # Sends every request to base_url, keeping its path and query
+    def __init__(self, base_url, **kwargs):
+        self.base_url = base_url
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = self.base_url + url.path + (f"?{url.query}" if url.query else "")
+        return super().send(request, **kwargs)
+
+
+def start_fake_server(args):
+    command = [sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_pluto.py'),
+               '--channels', str(args.channels), '--hours', str(args.hours), '--latency', str(args.latency)]
+    if args.fixtures:
+        command.extend(['--fixtures', args.fixtures])
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line:
+        server.wait()
+        sys.exit("Fake Pluto API did not start")
+    return server, line.rsplit(' ', 1)[-1].strip()
+
+def local_client(base_url, args):
+    client = pluto.Client(fetch_concurrency=args.concurrency, numbers_file="channel-numbers.json",
+                          render_processes=args.render_processes)
+    # Same pooling and retry policy as the real transport, aimed at the fake server
+    real = client.transport.session.get_adapter('https://')
+    adapter = LocalAdapter(base_url, pool_connections=4, pool_maxsize=real._pool_maxsize, max_retries=real.max_retries)
+    client.transport.session.mount('https://', adapter)
+    return client
+
+
+class Stages:
+    """Times stages and optionally their peak traced memory."""
+
+    def __init__(self, memory = False):
+        self.memory = memory
+        self.results = []
+        if memory:
+            tracemalloc.start()
+
+    def run(self, name, func, repeat = 1):
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        for _ in range(repeat):
+            result = func()
+        elapsed = (time.perf_counter() - started) / repeat
+        peak = tracemalloc.get_traced_memory()[1] - base if self.memory else None
+        self.results.append((name, elapsed, peak, repeat))
+        return result
+
+    def report(self):
+        print(f"{'stage':<48} {'time':>12} {'peak heap':>12}")
+        for name, elapsed, peak, repeat in self.results:
+            label = name if repeat == 1 else f"{name} (avg of {repeat})"
+            memory = f"{peak / 2**20:8.1f} MiB" if peak is not None else f"{'-':>12}"
+            print(f"{label:<48} {elapsed * 1000:9.3f} ms {memory}")
+        print(f"process peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+def check(result):
+    # Client calls return (value, error) or an error; stop on the first error
+    error = result[1] if isinstance(result, tuple) else result
+    if error:
+        sys.exit(f"Benchmark stage failed: {error}")
+    return result
+
+def bench_client(client, codes, stages, range_count):
+    for code in codes:
+        stages.run(f"boot {code}", lambda: check(client.resp_data(code)))
+    for code in codes:
+        stages.run(f"lineup fetch {code}", lambda: check(client.channels(code)))
+    stages.run(f"lineup cached {codes[0]}", lambda: check(client.channels(codes[0])), repeat=1000)
+    stages.run("lineup merged 'all'", lambda: check(client.channels_all()), repeat=100)
+
+    for code in codes:
+        stages.run(f"update_epg full {code}", lambda: check(client.update_epg(code, range_count, incremental=False)))
+    stages.run(f"update_epg incremental {codes[0]}", lambda: check(client.update_epg(codes[0], range_count, incremental=True)))
+
+    def render(code):
+        return sum(1 for page in client.epg_data[code] for _ in client.read_epg_data(page))
+    programmes = stages.run(f"read_epg_data {codes[0]}", lambda: render(codes[0]))
+
+    for code in codes:
+        stages.run(f"create_xml_file {code}", lambda: check(client.create_xml_file(code, refresh=False)))
+    stages.run("create_xml_file all", lambda: check(client.create_xml_file(codes, refresh=False)))
+    return programmes
+
+def bench_routes(client, codes, stages):
+    # pywsgi builds its own Client at import; swap in the one pointed at the fake server
+    os.environ.update({"PLUTO_CACHE_FILE": "", "PLUTO_CODE": ','.join(codes)})
+    import pywsgi
+    pywsgi.providers[pywsgi.provider] = client
+    http = pywsgi.app.test_client()
+    code = codes[0]
+
+    def get(path, status = 200, **kwargs):
+        response = http.get(path, **kwargs)
+        if response.status_code != status:
+            sys.exit(f"GET {path} returned {response.status_code}")
+        return response
+
+    stages.run(f"GET playlist.m3u {code} (render)", lambda: (pywsgi.playlist_cache.clear(), get(f"/pluto/{code}/playlist.m3u")))
+    stages.run(f"GET playlist.m3u {code} (cached)", lambda: get(f"/pluto/{code}/playlist.m3u"), repeat=200)
+    etag = get(f"/pluto/{code}/playlist.m3u").headers['ETag']
+    stages.run(f"GET playlist.m3u {code} (304)", lambda: get(f"/pluto/{code}/playlist.m3u", 304, headers={'If-None-Match': etag}), repeat=200)
+    stages.run("GET playlist.m3u all", lambda: get("/pluto/all/playlist.m3u"), repeat=20)
+    stages.run(f"GET channels {code}", lambda: get(f"/pluto/{code}/channels"), repeat=20)
+    stages.run(f"GET epg-{code}.xml", lambda: get(f"/pluto/epg/{code}/epg-{code}.xml"), repeat=20)
+    stages.run(f"GET epg-{code}.xml (gzip)", lambda: get(f"/pluto/epg/{code}/epg-{code}.xml", headers={'Accept-Encoding': 'gzip'}), repeat=20)
+    stages.run("GET epg-all.xml.gz", lambda: get("/pluto/epg/all/epg-all.xml.gz"), repeat=20)
+
+    group = client.all_channels[code][0].get('group') or ''
+    stages.run(f"GET playlist.m3u {code} filtered", lambda: get(f"/pluto/{code}/playlist.m3u?group={group}"), repeat=200)
+    stages.run("GET epg-all.xml filtered (subset)",
+               lambda: (pywsgi.epg_variant_cache.clear(), get(f"/pluto/epg/all/epg-all.xml?group={group}&hours=12")), repeat=20)
+    stages.run("GET epg-all.xml filtered (cached)", lambda: get(f"/pluto/epg/all/epg-all.xml?group={group}&hours=12"), repeat=200)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--channels', type=int, default=300, help="channels per country")
+    parser.add_argument('--hours', type=int, default=36, help="hours of guide data")
+    parser.add_argument('--latency', type=float, default=0, help="fake server delay per response in milliseconds")
+    parser.add_argument('--countries', default="local,us_east", help="comma separated country codes")
+    parser.add_argument('--concurrency', type=int, default=4, help="client fetch concurrency")
+    parser.add_argument('--render-processes', type=int, default=0, help="render worker processes")
+    parser.add_argument('--fixtures', help="replay recorded responses from this directory")
+    parser.add_argument('--memory', action='store_true', help="also report peak heap per stage (slower)")
+    parser.add_argument('--no-routes', action='store_true', help="skip the Flask route stages")
+    args = parser.parse_args()
+
+    codes = args.countries.split(',')
+    server, base_url = start_fake_server(args)
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    client = None
+    try:
+        client = local_client(base_url, args)
+        stages = Stages(args.memory)
+        programmes = bench_client(client, codes, stages, range_count=math.ceil(args.hours / 12))
+        if not args.no_routes:
+            bench_routes(client, codes, stages)
+        source = f"fixtures {args.fixtures}" if args.fixtures else f"{args.channels} channels, {args.hours}h"
+        print(f"{len(codes)} countries, {source}, {args.latency:g} ms latency; {programmes} programmes in {codes[0]}")
+        stages.report()
+    finally:
+        if client is not None and client.render_pool is not None:
+            client.render_pool.close()
+        server.terminate()
+        server.wait()
+        os.chdir(ROOT)
+        workdir.cleanup()
@@ -0,0 +1,65 @@
+"""Micro-benchmark: Pluto -> XMLTV timestamp conversion.
+
+Compares the strptime/strftime expressions read_epg_data used to run for
+every programme with the memoized converters in pluto.py. Run from the
+repository root:
+
+    python benchmarks/bench_timestamps.py
+"""
+import os, sys, timeit, random
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pluto
+
+PLUTO_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+def sample_timeline(channels = 1000, hours = 36):
+    # start/stop boundaries repeat across channels, as in a real guide
+    rnd = random.Random(0)
+    base = datetime(2024, 4, 18, 12, 0, 0)
+    values = []
+    for channel in range(channels):
+        t = base
+        while t < base + timedelta(hours=hours):
+            stop = t + timedelta(minutes=rnd.choice([30, 60, 90, 120]))
+            aired = base - timedelta(days=rnd.randint(0, 3650), seconds=rnd.randint(0, 86399))
+            values.append((t.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                           stop.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                           aired.strftime("%Y-%m-%dT%H:%M:%S.000Z")))
+            t = stop
+    return values
+
+def convert_strptime(values):
+    for start, stop, aired in values:
+        datetime.strptime(start, PLUTO_TIME_FORMAT).replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")
+        datetime.strptime(stop, PLUTO_TIME_FORMAT).replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")
+        datetime.strptime(aired, PLUTO_TIME_FORMAT).replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+        datetime.strptime(aired, PLUTO_TIME_FORMAT).strftime("%Y%m%d")
+
+def convert_fast(values):
+    for start, stop, aired in values:
+        pluto.xmltv_time(start)
+        pluto.xmltv_time(stop)
+        pluto.xmltv_air_date(aired)
+        pluto.xmltv_date(aired)
+
+def clear_caches():
+    pluto.xmltv_time.cache_clear()
+    pluto.xmltv_air_date.cache_clear()
+    pluto.xmltv_date.cache_clear()
+
+if __name__ == '__main__':
+    values = sample_timeline()
+    repeat = 3
+
+    baseline = min(timeit.repeat(lambda: convert_strptime(values), number=1, repeat=repeat))
+    cold = min(timeit.repeat(lambda: convert_fast(values), setup=clear_caches, number=1, repeat=repeat))
+    warm = min(timeit.repeat(lambda: convert_fast(values), number=1, repeat=repeat))
+
+    print(f"{len(values)} programmes, 4 conversions each")
+    print(f"strptime/strftime : {baseline * 1000:8.1f} ms")
+    print(f"fast, cold cache  : {cold * 1000:8.1f} ms  ({baseline / cold:5.1f}x)")
+    print(f"fast, warm cache  : {warm * 1000:8.1f} ms  ({baseline / warm:5.1f}x)")
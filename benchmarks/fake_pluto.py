@@ -0,0 +1,270 @@
+"""Local stand-in for the Pluto boot and service-channels APIs.
+
+Serves /v4/start, /v2/guide/channels, /v2/guide/categories and
+/v2/guide/timelines over plain HTTP so the client can be benchmarked
+without network access. Responses are synthetic and deterministic,
+sized by --channels and --hours, or replayed from recorded fixtures:
+
+    DIR/boot.json        a /v4/start response
+    DIR/channels.json    a /v2/guide/channels response
+    DIR/categories.json  a /v2/guide/categories response
+    DIR/timelines.json   a /v2/guide/timelines response, or a list of them
+
+Recorded timelines are shifted so the earliest programme starts at the
+current hour, then served for whatever window and channels are asked for.
+Every response is delayed by --latency milliseconds. Each country gets
+its own lineup, keyed by the client's X-Forwarded-For header, and a
+share of the channels is carried by every country, as in the real
+service.
+
+Run standalone (prints the port it listens on):
+
+    python benchmarks/fake_pluto.py --channels 400 --hours 36 --latency 50
+
+or use FakePluto from a benchmark; see bench_client.py.
+"""
+import argparse, base64, json, os, random, threading, time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+PLUTO_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# X-Forwarded-For values the client sends, see Client.x_forward
+COUNTRIES = {"": "local", "178.238.11.6": "uk", "192.206.151.131": "ca",
+             "108.82.206.181": "us_east", "76.81.9.69": "us_west"}
+
+GENRES = ["Action & Adventure", "Documentaries", "Crime Drama", "Kids", "Cartoons", "News + Opinion",
+          "Comedy", "Reality", "Sports Documentaries", "Unknown Genre", None]
+SERIES_TYPES = ["tv", "tv", "film", "live", "other"]
+CATEGORIES = ["News", "Movies", "Comedy", "Kids", "Sports", "Reality", "Explore", "Latino"]
+
+def pluto_time(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+def fake_token(country, lifetime = 4 * 60 * 60):
+    # Unsigned JWT with an "exp" claim, enough for Client.token_expiry
+    def encode(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b'=').decode()
+    return '.'.join([encode({"alg": "none"}), encode({"country": country, "exp": int(time.time()) + lifetime}), "sig"])
+
+
+class SyntheticGuide:
+    """Deterministic lineups and schedules of a given size.
+
+    Every country has channels channels, a shared fraction of which are in
+    all lineups. Schedules run hours past the current hour and are empty
+    beyond that, like the end of the real guide.
+    """
+
+    def __init__(self, channels = 300, shared = 0.2, hours = 36):
+        self.channels = channels
+        self.shared = int(channels * shared)
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        self.horizon = now + timedelta(hours=hours)
+
+    def channel_ids(self, country):
+        ids = [f"{i:024x}" for i in range(self.shared)]
+        prefix = country.encode().hex()
+        ids.extend(f"{prefix}{i:0{24 - len(prefix)}x}" for i in range(self.channels - self.shared))
+        return ids
+
+    def boot(self, country):
+        return {"sessionToken": fake_token(country), "stitcherParams": "deviceDNT=0&deviceModel=web"}
+
+    def lineup(self, country):
+        data = []
+        for i, channel_id in enumerate(self.channel_ids(country)):
+            data.append({"id": channel_id,
+                         "name": f"Channel {i} & <{country}>",
+                         "slug": f"channel-{channel_id}",
+                         "tmsid": None if i % 3 else f"{100000 + i}",
+                         "summary": f"Summary for channel {i}",
+                         "number": 100 + i,
+                         "images": [{"type": "logo", "url": f"http://images.local/{channel_id}/logo.png"},
+                                    {"type": "colorLogoPNG", "url": f"http://images.local/{channel_id}/color.png"}]})
+        return {"data": data}
+
+    def categories(self, country):
+        ids = self.channel_ids(country)
+        return {"data": [{"name": name, "channelIDs": ids[i::len(CATEGORIES)]} for i, name in enumerate(CATEGORIES)]}
+
+    def schedule(self, channel_id, start, stop):
+        # Programmes are made of 30 minute slots laid out from a fixed epoch,
+        # so overlapping windows agree. A slot whose seeded draw is below 0.5
+        # runs on into the next one.
+        stop = min(stop, self.horizon)
+        epoch = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        slot = timedelta(minutes=30)
+        index = int((start - epoch) / slot)
+        t = epoch + index * slot
+        # Step back to the start of the programme that covers t
+        while index > 0 and random.Random(f"{channel_id}:{index - 1}").random() < 0.5:
+            index -= 1
+            t -= slot
+        timelines = []
+        while t < stop:
+            rnd = random.Random(f"{channel_id}:{index}")
+            length = 1
+            while random.Random(f"{channel_id}:{index + length - 1}").random() < 0.5:
+                length += 1
+            end = t + length * slot
+            if end > start:
+                series_type = rnd.choice(SERIES_TYPES)
+                aired = t if series_type == "live" else epoch - timedelta(days=rnd.randint(0, 3650))
+                episode = {"_id": f"ep{rnd.getrandbits(48):012x}",
+                           "name": rnd.choice(["Pilot", "The Return", "Finale", f"Episode {rnd.randint(1, 99)}"]),
+                           "description": "A &quot;synthetic&quot; description " * rnd.randint(1, 4),
+                           "season": rnd.randint(0, 9),
+                           "number": rnd.randint(1, 24),
+                           "clip": {"originalReleaseDate": pluto_time(aired)},
+                           "series": {"_id": f"series{rnd.randint(0, 500)}", "type": series_type,
+                                      "tile": {"path": f"http://images.local/series/{rnd.randint(0, 500)}.jpg"}}}
+                genre, sub_genre = rnd.choice(GENRES), rnd.choice(GENRES)
+                if genre: episode["genre"] = genre
+                if sub_genre: episode["subGenre"] = sub_genre
+                timelines.append({"_id": f"tl{rnd.getrandbits(48):012x}",
+                                  "start": pluto_time(t), "stop": pluto_time(end),
+                                  "title": rnd.choice(["Pilot", f"Show {rnd.randint(0, 300)}"]),
+                                  "episode": episode})
+            index += length
+            t = end
+        return timelines
+
+    def timelines(self, country, channel_ids, start, stop):
+        return [{"channelId": channel_id, "timelines": self.schedule(channel_id, start, stop)} for channel_id in channel_ids]
+
+
+class RecordedGuide:
+    """Replays recorded API responses from a fixtures directory."""
+
+    def __init__(self, path):
+        def load(name):
+            with open(os.path.join(path, name), encoding='utf-8') as f:
+                return json.load(f)
+
+        self.boot_data = load("boot.json")
+        self.lineup_data = load("channels.json")
+        self.categories_data = load("categories.json")
+        recorded = load("timelines.json")
+        if isinstance(recorded, dict):
+            recorded = [recorded]
+
+        self.recorded = {}
+        for page in recorded:
+            for entry in page.get("data", []):
+                self.recorded.setdefault(entry["channelId"], []).extend(entry.get("timelines", []))
+
+        # Move the recorded schedule so it starts at the current hour
+        starts = [datetime.strptime(t["start"], PLUTO_TIME_FORMAT) for ts in self.recorded.values() for t in ts]
+        now = datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0)
+        shift = now - min(starts) if starts else timedelta(0)
+        for timelines in self.recorded.values():
+            for t in timelines:
+                t["start"] = pluto_time(datetime.strptime(t["start"], PLUTO_TIME_FORMAT) + shift)
+                t["stop"] = pluto_time(datetime.strptime(t["stop"], PLUTO_TIME_FORMAT) + shift)
+
+    def boot(self, country):
+        return dict(self.boot_data, sessionToken=fake_token(country))
+
+    def lineup(self, country):
+        return self.lineup_data
+
+    def categories(self, country):
+        return self.categories_data
+
+    def timelines(self, country, channel_ids, start, stop):
+        start, stop = pluto_time(start), pluto_time(stop)
+        return [{"channelId": channel_id,
+                 "timelines": [t for t in self.recorded.get(channel_id, []) if t["stop"] > start and t["start"] < stop]}
+                for channel_id in channel_ids]
+
+
+class FakePluto:
+    """Threaded HTTP server answering like the Pluto APIs.
+
+    requests counts the calls per path. Use base_url with a client whose
+    https:// requests are redirected here (see bench_client.LocalAdapter).
+    """
+
+    def __init__(self, guide, latency = 0.0, host = '127.0.0.1', port = 0):
+        self.guide = guide
+        self.latency = latency
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with fake.lock:
+                    fake.requests[url.path] = fake.requests.get(url.path, 0) + 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, data = fake.respond(url.path, {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()},
+                                            COUNTRIES.get(self.headers.get("X-Forwarded-For", ""), "local"))
+                body = json.dumps(data, separators=(',', ':')).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def respond(self, path, params, country):
+        if path.endswith("/v4/start"):
+            return 200, self.guide.boot(country)
+        if path.endswith("/v2/guide/channels"):
+            return 200, self.guide.lineup(country)
+        if path.endswith("/v2/guide/categories"):
+            return 200, self.guide.categories(country)
+        if path.endswith("/v2/guide/timelines"):
+            start = datetime.strptime(params["start"], PLUTO_TIME_FORMAT).replace(tzinfo=timezone.utc)
+            stop = start + timedelta(minutes=int(params["duration"]))
+            channel_ids = [channel_id for channel_id in params.get("channelIds", "").split(",") if channel_id]
+            return 200, {"meta": {"startDateTime": pluto_time(start), "endDateTime": pluto_time(stop)},
+                         "data": self.guide.timelines(country, channel_ids, start, stop)}
+        return 404, {"error": "not found"}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--channels', type=int, default=300, help="channels per country")
+    parser.add_argument('--hours', type=int, default=36, help="hours of schedule past the current hour")
+    parser.add_argument('--latency', type=float, default=0, help="delay per response in milliseconds")
+    parser.add_argument('--fixtures', help="directory of recorded responses to replay")
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+
+    guide = RecordedGuide(args.fixtures) if args.fixtures else SyntheticGuide(args.channels, hours=args.hours)
+    fake = FakePluto(guide, latency=args.latency / 1000, port=args.port)
+    print(f"Fake Pluto API listening on {fake.base_url}", flush=True)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,51 @@
+import json, sqlite3, time
+from contextlib import closing
+
+class CacheStore:
+    """Small SQLite key/value store that lets Client state survive restarts.
+
+    Values are JSON documents grouped by kind ("boot", "lineup",
+    "timelines") and keyed by country code. Each call opens its own
+    connection, so the store can be used from any thread or greenlet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self.connect()) as db:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS cache ("
+                           " kind TEXT NOT NULL,"
+                           " key TEXT NOT NULL,"
+                           " saved_at REAL NOT NULL,"
+                           " value TEXT NOT NULL,"
+                           " PRIMARY KEY (kind, key))")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save(self, kind, key, value):
+        try:
+            data = json.dumps(value, separators=(',', ':'))
+            with closing(self.connect()) as db:
+                with db:
+                    db.execute("INSERT OR REPLACE INTO cache (kind, key, saved_at, value) VALUES (?, ?, ?, ?)",
+                               (kind, key, time.time(), data))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"Unable to cache {kind} for {key}: {e}")
+
+    def load(self, kind):
+        # {key: value} for every entry of a kind; unreadable entries are skipped
+        try:
+            with closing(self.connect()) as db:
+                rows = db.execute("SELECT key, value FROM cache WHERE kind = ?", (kind,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Unable to read cached {kind}: {e}")
+            return {}
+
+        entries = {}
+        for key, data in rows:
+            try:
+                entries[key] = json.loads(data)
+            except ValueError:
+                print(f"Ignoring unreadable cached {kind} for {key}")
+        return entries
@@ -0,0 +1,84 @@
+import json, os, threading
+
+# Numbers below these offsets are moved into a per-country block in the
+# combined "all" lineup so they don't collide with US channel numbers
+COUNTRY_OFFSETS = {'ca': 6000, 'uk': 7000, 'fr': 8000}
+
+def offset_number(country_code, number):
+    offset = COUNTRY_OFFSETS.get((country_code or '').lower())
+    if offset is not None and number is not None and number < offset:
+        number += offset
+    return number
+
+
+class ChannelNumbers:
+    """Unique, stable channel numbers for each lineup ("scope").
+
+    A channel keeps the number it was given on a previous refresh as long as
+    it stays in the lineup, so DVR clients don't see channels jump around.
+    New channels get their desired number, or the next free one above it.
+    Assignments are persisted to a JSON file when path is set.
+    """
+
+    def __init__(self, path = None):
+        self.path = path
+        self.assigned = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.assigned = {scope: {channel_id: int(number) for channel_id, number in numbers.items()}
+                                 for scope, numbers in json.load(f).items()}
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Ignoring unreadable channel number file {self.path}: {e}")
+            self.assigned = {}
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.assigned, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Unable to save channel numbers to {self.path}: {e}")
+
+    def assign(self, scope, channels):
+        # channels: (channel_id, desired_number) pairs in priority order.
+        # Returns {channel_id: number}. Runs in near-linear time: taken numbers
+        # point at the next candidate, and the chains are path-compressed.
+        channels = [(channel_id, int(desired or 0)) for channel_id, desired in channels]
+        with self.lock:
+            previous = self.assigned.get(scope, {})
+            numbers = {}
+            next_free = {}
+
+            def claim(number):
+                path = []
+                while number in next_free:
+                    path.append(number)
+                    number = next_free[number]
+                for taken in path:
+                    next_free[taken] = number + 1
+                next_free[number] = number + 1
+                return number
+
+            # Channels seen before keep their number
+            for channel_id, desired in channels:
+                number = previous.get(channel_id)
+                if number is not None and number not in next_free and channel_id not in numbers:
+                    numbers[channel_id] = claim(number)
+
+            for channel_id, desired in channels:
+                if channel_id not in numbers:
+                    numbers[channel_id] = claim(desired)
+
+            if numbers != previous:
+                self.assigned[scope] = numbers
+                self.save()
+        return numbers
@@ -0,0 +1,104 @@
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+class GuideIndex:
+    """Per-channel programme arrays sorted by start time.
+
+    Built from a timeline store ({channelId: {start: Programme}}) after each
+    refresh and never modified afterwards, so lookups need no locking. Times
+    are Pluto timestamps ("YYYY-mm-ddTHH:MM:SS.mmmZ"), which sort correctly
+    as strings. Programmes of a channel are assumed not to overlap, as in
+    the upstream guide. Every lookup is a binary search, O(log n) in the
+    number of programmes of the channel.
+    """
+
+    def __init__(self, store):
+        self.channels = {}
+        for channel_id, timelines in store.items():
+            keys = sorted(timelines)
+            self.channels[channel_id] = (keys, [timelines[key] for key in keys])
+
+    def __contains__(self, channel_id):
+        return channel_id in self.channels
+
+    def now_next(self, channel_id, at):
+        # (programme airing at `at` or None, the one after it or None)
+        starts, programmes = self.channels.get(channel_id, ((), ()))
+        i = bisect_right(starts, at) - 1
+        current = programmes[i] if i >= 0 and programmes[i].stop > at else None
+        upcoming = programmes[i + 1] if i + 1 < len(programmes) else None
+        return current, upcoming
+
+    def schedule(self, channel_id, start, stop):
+        # Programmes that overlap [start, stop), in start order
+        starts, programmes = self.channels.get(channel_id, ((), ()))
+        first = bisect_right(starts, start) - 1
+        if first < 0 or programmes[first].stop <= start:
+            first += 1
+        return programmes[first:bisect_left(starts, stop)]
+
+
+def index_changes(previous, current, ended_before):
+    # Programme changes from one GuideIndex to the next, as a list of
+    # (channel_id, start, action, programme) where action is 'added',
+    # 'changed' or 'removed' (with programme None). Programmes that ended
+    # before ended_before were evicted rather than removed and are skipped.
+    changes = []
+    removed_channels = [channel_id for channel_id in previous.channels if channel_id not in current.channels]
+    for channel_id in list(current.channels) + removed_channels:
+        before = dict(zip(*previous.channels.get(channel_id, ((), ()))))
+        after = dict(zip(*current.channels.get(channel_id, ((), ()))))
+        for start, programme in after.items():
+            old = before.get(start)
+            if old is None:
+                changes.append((channel_id, start, 'added', programme))
+            elif old != programme:
+                changes.append((channel_id, start, 'changed', programme))
+        for start, programme in before.items():
+            if start not in after and programme.stop > ended_before:
+                changes.append((channel_id, start, 'removed', None))
+    return changes
+
+def merge_changes(entries):
+    # Collapse (version, changes) entries, oldest first, into the net change
+    # per programme: added then removed cancels out, removed then added is a
+    # change, and the latest programme wins
+    net = {}
+    for _, changes in entries:
+        for channel_id, start, action, programme in changes:
+            key = (channel_id, start)
+            existed = net[key][0] if key in net else action != 'added'
+            net[key] = (existed, programme)
+    merged = []
+    for (channel_id, start), (existed, programme) in net.items():
+        if programme is not None:
+            merged.append((channel_id, start, 'changed' if existed else 'added', programme))
+        elif existed:
+            merged.append((channel_id, start, 'removed', None))
+    return merged
+
+
+class ChangeLog:
+    """Programme changes of one country's guide, by version.
+
+    A version is the millisecond timestamp of the refresh that produced it.
+    base is the version the log starts from; changes since an older version
+    are no longer known and the client has to fetch the full guide. Only the
+    last max_entries refreshes are kept, which moves base forward.
+    """
+
+    def __init__(self, base, max_entries = 48):
+        self.base = base
+        self.version = base
+        self.max_entries = max_entries
+        self.entries = deque()
+
+    def record(self, version, changes):
+        self.entries.append((version, changes))
+        self.version = version
+        while len(self.entries) > self.max_entries:
+            self.base = self.entries.popleft()[0]
+
+    def since(self, version):
+        # (version, changes) entries newer than version, oldest first
+        return [entry for entry in self.entries if entry[0] > version]
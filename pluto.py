@@ -1,22 +1,500 @@
-import uuid, requests, json, pytz, gzip, re
+import uuid, json, pytz, re, os, threading, base64, time, io
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 import xml.etree.ElementTree as ET
+from xmltv import XMLTVWriter, write_xmltv
+from channel_numbers import ChannelNumbers, offset_number
+from cache_store import CacheStore
+from transport import Transport
+from render_pool import RenderPool
+from metrics import Counter, Gauge, Histogram
+from profiling import PROFILER, StageTimer, format_timings
+from guide_index import ChangeLog, GuideIndex, index_changes, merge_changes
+
+# XMLTV category -> Pluto genre/subGenre strings that map to it
+SERIES_GENRES = {
+    "Animated": ["Family Animation", "Cartoons"],
+    "Educational": ["Education & Guidance", "Instructional & Educational"],
+    "News": ["News and Information", "General News", "News + Opinion", "General News"],
+    "History": ["History & Social Studies"],
+    "Politics": ["Politics"],
+    "Action":
+        [
+          "Action & Adventure",
+          "Action Classics",
+          "Martial Arts",
+          "Crime Action",
+          "Family Adventures",
+          "Action Sci-Fi & Fantasy",
+          "Action Thrillers",
+          "African-American Action",
+        ],
+    "Adventure": ["Action & Adventure", "Adventures", "Sci-Fi Adventure"],
+    "Reality":
+        [
+          "Reality",
+          "Reality Drama",
+          "Courtroom Reality",
+          "Occupational Reality",
+          "Celebrity Reality",
+        ],
+    "Documentary":
+        [
+          "Documentaries",
+          "Social & Cultural Documentaries",
+          "Science and Nature Documentaries",
+          "Miscellaneous Documentaries",
+          "Crime Documentaries",
+          "Travel & Adventure Documentaries",
+          "Sports Documentaries",
+          "Military Documentaries",
+          "Political Documentaries",
+          "Foreign Documentaries",
+          "Religion & Mythology Documentaries",
+          "Historical Documentaries",
+          "Biographical Documentaries",
+          "Faith & Spirituality Documentaries",
+        ],
+    "Biography": ["Biographical Documentaries", "Inspirational Biographies"],
+    "Science Fiction": ["Sci-Fi Thrillers", "Sci-Fi Adventure", "Action Sci-Fi & Fantasy"],
+    "Thriller": ["Sci-Fi Thrillers", "Thrillers", "Crime Thrillers"],
+    "Talk": ["Talk & Variety", "Talk Show"],
+    "Variety": ["Sketch Comedies"],
+    "Home Improvement": ["Art & Design", "DIY & How To", "Home Improvement"],
+    "House/garden": ["Home & Garden"],
+    # "Science": ["Science and Nature Documentaries"],
+    # "Nature": ["Science and Nature Documentaries", "Animals"],
+    "Cooking": ["Cooking Instruction", "Food & Wine", "Food Stories"],
+    "Travel": ["Travel & Adventure Documentaries", "Travel"],
+    "Western": ["Westerns", "Classic Westerns"],
+    "LGBTQ": ["Gay & Lesbian", "Gay & Lesbian Dramas", "Gay"],
+    "Game show": ["Game Show"],
+    "Military": ["Classic War Stories"],
+    "Comedy":
+        [
+          "Cult Comedies",
+          "Spoofs and Satire",
+          "Slapstick",
+          "Classic Comedies",
+          "Stand-Up",
+          "Sports Comedies",
+          "African-American Comedies",
+          "Showbiz Comedies",
+          "Sketch Comedies",
+          "Teen Comedies",
+          "Latino Comedies",
+          "Family Comedies",
+        ],
+    "Crime": ["Crime Action", "Crime Drama", "Crime Documentaries"],
+    "Sports": ["Sports","Sports & Sports Highlights","Sports Documentaries", "Poker & Gambling"],
+    "Poker & Gambling": ["Poker & Gambling"],
+    "Crime drama": ["Crime Drama"],
+    "Drama":
+        [
+          "Classic Dramas",
+          "Family Drama",
+          "Indie Drama",
+          "Romantic Drama",
+          "Crime Drama",
+        ],
+    "Children": ["Kids", "Children & Family", "Kids' TV", "Cartoons", "Animals", "Family Animation", "Ages 2-4", "Ages 11-12",],
+}
+
+def load_genre_file(path):
+    # Extra mappings in the same shape as SERIES_GENRES, as a JSON object of
+    # {"XMLTV category": ["Pluto genre", ...]}
+    with open(path, encoding='utf-8') as f:
+        extra = json.load(f)
+    for category, genres in extra.items():
+        known = SERIES_GENRES.setdefault(category, [])
+        known.extend(genre for genre in genres if genre not in known)
+
+def build_genre_index(series_genres):
+    # Invert SERIES_GENRES into Pluto genre -> ordered XMLTV categories
+    index = {}
+    for category, genres in series_genres.items():
+        for genre in genres:
+            categories = index.setdefault(genre, [])
+            if category not in categories:
+                categories.append(category)
+    return index
+
+if os.environ.get("PLUTO_GENRES_FILE"):
+    load_genre_file(os.environ["PLUTO_GENRES_FILE"])
+GENRE_INDEX = build_genre_index(SERIES_GENRES)
+
+PLUTO_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+def is_plain_pluto_time(value):
+    # "YYYY-MM-DDTHH:MM:SS.mmmZ", the layout Pluto uses for every timestamp.
+    # Years before 1000 take the strptime path because strftime does not pad them.
+    return (len(value) == 24 and value[0] != '0' and value[4] == '-' and value[7] == '-' and value[10] == 'T'
+            and value[13] == ':' and value[16] == ':' and value[19] == '.' and value[23] == 'Z'
+            and value[20:23].isdigit())
+
+def parse_pluto_time(value):
+    if is_plain_pluto_time(value):
+        try:
+            # fromisoformat is implemented in C and still range checks every field
+            return datetime.fromisoformat(value[:23])
+        except ValueError:
+            pass
+    return datetime.strptime(value, PLUTO_TIME_FORMAT)
+
+# The converters below are memoized: start/stop boundaries repeat across
+# channels and original release dates repeat across airings.
+@lru_cache(maxsize=65536)
+def xmltv_time(value):
+    # Pluto timestamp -> XMLTV "YYYYmmddHHMMSS +0000"
+    dt = parse_pluto_time(value)
+    if is_plain_pluto_time(value):
+        return f"{value[0:4]}{value[5:7]}{value[8:10]}{value[11:13]}{value[14:16]}{value[17:19]} +0000"
+    return dt.replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")
+
+@lru_cache(maxsize=65536)
+def xmltv_air_date(value):
+    # Pluto timestamp -> original-air-date "YYYY-mm-ddTHH:MM:SS.mmmZ"
+    dt = parse_pluto_time(value)
+    if is_plain_pluto_time(value):
+        return value
+    return dt.replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+
+@lru_cache(maxsize=65536)
+def xmltv_date(value):
+    # Pluto timestamp -> XMLTV <date> "YYYYmmdd"
+    dt = parse_pluto_time(value)
+    if is_plain_pluto_time(value):
+        return f"{value[0:4]}{value[5:7]}{value[8:10]}"
+    return dt.strftime("%Y%m%d")
+
+def cached_time(value):
+    # An aware datetime saved with isoformat() in the persistent cache
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        raise ValueError(f"timestamp without time zone: {value}")
+    return moment
+
+def token_expiry(token):
+    # Expiry of a JWT from its "exp" claim, or None if it can't be read
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return datetime.fromtimestamp(int(json.loads(base64.urlsafe_b64decode(payload))['exp']), pytz.utc)
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+ILLEGAL_CHARACTERS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def strip_illegal_characters(xml_string):
+    # Remove characters that are not allowed in XML 1.0
+    return ILLEGAL_CHARACTERS.sub('', xml_string)
+
+def genre_categories(genre):
+    # XMLTV categories for a Pluto genre, or the genre itself if unmapped
+    return GENRE_INDEX.get(genre, [genre])
+
+def channel_elements(station_list):
+    # Yield one <channel> element per station
+    for station in station_list:
+        channel = ET.Element("channel", attrib={"id": station["id"]})
+        display_name = ET.SubElement(channel, "display-name")
+        display_name.text = strip_illegal_characters(station["name"])
+        icon = ET.SubElement(channel, "icon", attrib={"src": station["logo"]})
+        yield channel
+
+# Compact programme record holding only the timelines API fields the guide uses
+Programme = namedtuple('Programme', ['start', 'stop', 'title', 'episode_id', 'name', 'description', 'season', 'number',
+                                     'release', 'series_id', 'series_type', 'tile', 'genre', 'sub_genre'])
+
+def compact_timeline(timeline, strings):
+    # Project one timelines API entry onto a Programme. Repeated strings
+    # (titles, series ids, tile URLs, genres, ...) are shared through the
+    # strings dict, so each distinct value of a refresh is stored once.
+    def shared(value):
+        return strings.setdefault(value, value) if isinstance(value, str) else value
+
+    episode = timeline.get("episode") or {}
+    series = episode.get("series") or {}
+    return Programme(shared(timeline.get("start")), shared(timeline.get("stop")), shared(timeline.get("title")),
+                     shared(episode.get("_id")), shared(episode.get("name")), shared(episode.get("description")),
+                     episode.get("season"), episode.get("number"),
+                     shared((episode.get("clip") or {}).get("originalReleaseDate")),
+                     shared(series.get("_id")), shared(series.get("type", "")), shared((series.get("tile") or {}).get("path")),
+                     shared(episode.get("genre")), shared(episode.get("subGenre")))
+
+def compact_page(page, strings):
+    # A timelines API response with every timeline replaced by a Programme
+    return {'meta': page.get('meta'),
+            'data': [{'channelId': entry['channelId'],
+                      'timelines': [compact_timeline(timeline, strings) for timeline in entry.get('timelines') or []]}
+                     for entry in page.get('data', [])]}
+
+def restore_programme(row, strings):
+    # A Programme from the list of its fields, as saved in the cache
+    return Programme(*[strings.setdefault(value, value) if isinstance(value, str) else value for value in row])
+
+def timeline_dict(programme):
+    # A Programme in the timelines API layout, for epg.json
+    episode = {"_id": programme.episode_id,
+               "name": programme.name,
+               "description": programme.description,
+               "season": programme.season,
+               "number": programme.number,
+               "clip": {"originalReleaseDate": programme.release},
+               "series": {"_id": programme.series_id, "type": programme.series_type, "tile": {"path": programme.tile}}}
+    if programme.genre is not None: episode.update({"genre": programme.genre})
+    if programme.sub_genre is not None: episode.update({"subGenre": programme.sub_genre})
+    return {"start": programme.start, "stop": programme.stop, "title": programme.title, "episode": episode}
+
+def programme_elements(resp):
+    # Yield one <programme> element per Programme of a page
+    for entry in resp["data"]:
+        for timeline in entry["timelines"]:
+            # Create programme element
+            programme = ET.Element("programme", attrib={"channel": entry["channelId"],
+                                                       "start": xmltv_time(timeline.start),
+                                                       "stop": xmltv_time(timeline.stop)})
+            # Add sub-elements to programme
+            title = ET.SubElement(programme, "title")
+            title.text = strip_illegal_characters(timeline.title)
+            if timeline.series_type == "live":
+                if timeline.release == timeline.start:
+                    live = ET.SubElement(programme, "live")
+                if timeline.season:
+                    episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
+                    episode_num_onscreen.text = f'S{timeline.season:02d}E{timeline.number:02d}'
+                    episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
+                    episode_num_pluto.text = timeline.episode_id
+            elif timeline.series_type == "tv":
+                episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
+                episode_num_onscreen.text = f'S{timeline.season:02d}E{timeline.number:02d}'
+                episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
+                episode_num_pluto.text = timeline.episode_id
+            episode_num_air_date = ET.SubElement(programme, "episode-num", attrib={"system": "original-air-date"})
+            episode_num_air_date.text = xmltv_air_date(timeline.release)
+            desc = ET.SubElement(programme, "desc")
+            desc.text = strip_illegal_characters(timeline.description).replace('&quot;', '"')
+            icon_programme = ET.SubElement(programme, "icon", attrib={"src": timeline.tile})
+            date = ET.SubElement(programme, "date")
+            date.text = xmltv_date(timeline.release)
+            series_id_pluto = ET.SubElement(programme, "series-id", attrib={"system": "pluto"})
+            series_id_pluto.text = timeline.series_id
+            if timeline.title.lower() != timeline.name.lower():
+                sub_title = ET.SubElement(programme, "sub-title")
+                sub_title.text = strip_illegal_characters(timeline.name)
+            categories = []
+            if timeline.genre is not None:
+                categories.extend(genre_categories(timeline.genre))
+            if timeline.series_type == "tv":
+                categories.append("Series")
+            if timeline.series_type == "film":
+                categories.append("Movie")
+            if timeline.sub_genre is not None:
+                categories.extend(genre_categories(timeline.sub_genre))
+
+            # dict.fromkeys drops duplicates and keeps first-seen order
+            for category in dict.fromkeys(categories):
+                category_elem = ET.SubElement(programme, "category")
+                category_elem.text = category
+
+            yield programme
+
+GUIDE_ATTRIB = {"generator-info-name": "jgomez177", "generated-ts": ""}
+
+def render_guide(xml_file_path, station_list, program_data, cooperative = False):
+    # Write an XMLTV guide (and its .gz copy) for the given stations and
+    # timeline pages. Runs in the server or in a render worker process; with
+    # cooperative set it yields to other greenlets while it works.
+    def elements():
+        yield from channel_elements(station_list)
+
+        for elem in program_data:
+            for count, programme in enumerate(programme_elements(elem)):
+                # Rendering is CPU bound; under gevent, sleep(0) lets
+                # HTTP requests run between batches of programmes
+                if cooperative and count % 500 == 499:
+                    time.sleep(0)
+                yield programme
+
+    # Stream the guide to the XML file and its gzip copy in one pass
+    return write_xmltv(xml_file_path, GUIDE_ATTRIB, elements())
+
+def changes_xmltv(changes):
+    # XMLTV document of the added and changed programmes of epg_changes
+    page = {'data': [{'channelId': channel_id, 'timelines': [programme]}
+                     for channel_id, _, _, programme in changes if programme is not None]}
+    buffer = io.BytesIO()
+    writer = XMLTVWriter([buffer], GUIDE_ATTRIB)
+    for programme in programme_elements(page):
+        writer.write_element(programme)
+    writer.close()
+    return buffer.getvalue()
+
+TOKEN_REFRESHES = Counter('pluto_token_refreshes_total', "Boot requests for a new session token", ['country', 'result'])
+EPG_BUILD_SECONDS = Histogram('pluto_epg_build_seconds', "Guide build time by stage: fetch, merge, render, serialize, compress",
+                              ['country', 'stage'])
+EPG_FILE_BYTES = Gauge('pluto_epg_file_bytes', "Size of the last published guide file", ['country', 'format'])
+EPG_PROGRAMMES = Gauge('pluto_epg_programmes', "Programmes in the last published guide", ['country'])
+EPG_CHANNELS = Gauge('pluto_epg_channels', "Channels in the last published guide", ['country'])
+
+# Request headers shared by every call to a Pluto host. Per-country copies
+# with X-Forwarded-For are built once by Client.request_headers.
+BOOT_HEADERS = {
+    'authority': 'boot.pluto.tv',
+    'accept': '*/*',
+    'accept-language': 'en-US,en;q=0.9',
+    'origin': 'https://pluto.tv',
+    'referer': 'https://pluto.tv/',
+    'sec-ch-ua': '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Linux"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-site',
+    'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    }
+
+SERVICE_HEADERS = {
+    'authority': 'service-channels.clusters.pluto.tv',
+    'accept': '*/*',
+    'accept-language': 'en-US,en;q=0.9',
+    'origin': 'https://pluto.tv',
+    'referer': 'https://pluto.tv/',
+    }
 
 class Client:
-    def __init__(self):
-        self.session = requests.Session()
+    def __init__(self, fetch_concurrency = 4, incremental_epg = False, lineup_ttl = 1800, numbers_file = "channel-numbers.json",
+                 token_refresh_margin = 300, cache_file = None, connect_timeout = 5, read_timeout = 30, http_retries = 3,
+                 render_processes = 0, refresh_countries = None):
+        # Maximum number of timeline requests in flight at once (1 = serial)
+        self.fetch_concurrency = max(1, int(fetch_concurrency))
+        # Incremental EPG refresh: re-fetch only recent changes and the new tail
+        self.incremental_epg = incremental_epg
+        self.epg_recent_minutes = 120
+        self.epg_full_refresh = timedelta(hours=24)
+        # Seconds a channel lineup is served from cache before it is refreshed
+        self.lineup_ttl = timedelta(seconds=lineup_ttl)
+        self.x_forward = {"local": {"X-Forwarded-For":""},
+                          "uk": {"X-Forwarded-For":"178.238.11.6"},
+                          "ca": {"X-Forwarded-For":"192.206.151.131"},
+                          "us_east": {"X-Forwarded-For":"108.82.206.181"},
+                          "us_west": {"X-Forwarded-For":"76.81.9.69"},}
+        # Every country refreshes in its own job, so up to fetch_concurrency
+        # timeline requests per configured country can be in flight at once.
+        # The semaphore caps them client-wide, and the pool keeps a connection
+        # for each of them plus one lineup request per supported country.
+        countries = len(refresh_countries) if refresh_countries else len(self.x_forward)
+        self.timeline_slots = threading.BoundedSemaphore(self.fetch_concurrency * countries)
+        self.transport = Transport(pool_maxsize=max(10, self.fetch_concurrency * countries + len(self.x_forward)),
+                                   connect_timeout=connect_timeout,
+                                   read_timeout=read_timeout,
+                                   retries=http_retries)
+        self.header_sets = {}
+        # Refresh boot tokens this long before they expire
+        self.token_refresh_margin = timedelta(seconds=token_refresh_margin)
+        # Countries whose tokens are refreshed ahead of expiry (None for every
+        # supported country); others are refreshed when a request needs them
+        self.refresh_countries = refresh_countries
+        self.token_retry = timedelta(seconds=60)
         self.sessionAt = {}
         self.response_list = {}
+        self.token_locks = {}
+        self.token_timers = {}
         self.epg_data = {}
+        self.timeline_store = {}
+        self.epg_horizon = {}
+        # GuideIndex of the stored timelines by country, replaced after every refresh
+        self.guide_index = {}
+        # ChangeLog of programme changes between refreshes, by country
+        self.guide_changes = {}
+        self.guide_version = 0
+        self.version_lock = threading.Lock()
+        # Seconds per stage of the last update_epg run, by country
+        self.epg_timings = {}
+        self.epg_full_at = {}
         self.device = None
         self.all_channels = {}
+        self.channelsAt = {}
+        self.lineupVersion = {}
+        self.all_lineup = None
+        # Persisted channel number assignments (None keeps them in memory only)
+        self.channel_numbers = ChannelNumbers(numbers_file)
+        self.lineup_locks = {}
+        self.epg_updated = {}
+        self.epg_locks = {}
+        self.build_state = {}
+        self.all_stale = False
+        # Render guides in worker processes (0 renders in the server process)
+        self.render_pool = RenderPool(render_processes) if render_processes else None
+        # Persistent cache of boot responses, lineups and timelines (None disables it)
+        self.cache = CacheStore(cache_file) if cache_file else None
 
         self.load_device()
-        self.x_forward = {"local": {"X-Forwarded-For":""},
-                          "uk": {"X-Forwarded-For":"178.238.11.6"},
-                          "ca": {"X-Forwarded-For":"192.206.151.131"},
-                          "us_east": {"X-Forwarded-For":"108.82.206.181"},
-                          "us_west": {"X-Forwarded-For":"76.81.9.69"},}
+        self.load_cache()
+
+    def load_cache(self):
+        # Restore state saved by a previous run so a warm restart can serve
+        # playlists and guides right away. Expired boot tokens are dropped;
+        # stale lineups and timelines are refreshed through the usual paths.
+        if self.cache is None:
+            return
+        now = datetime.now(pytz.utc)
+
+        for country_code, value in self.cache.load('boot').items():
+            if country_code not in self.x_forward:
+                continue
+            try:
+                resp = value.get('resp')
+                session_at = cached_time(value.get('sessionAt'))
+                expires = token_expiry(resp.get('sessionToken')) or session_at + timedelta(hours=4)
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                print(f"Ignoring unreadable cached token for {country_code}: {e}")
+                continue
+            if expires > now:
+                self.response_list.update({country_code: resp})
+                self.sessionAt.update({country_code: session_at})
+                self.schedule_token_refresh(country_code, (self.token_refresh_at(country_code) - now).total_seconds())
+
+        for country_code, value in self.cache.load('lineup').items():
+            if country_code not in self.x_forward:
+                continue
+            try:
+                stations = list(value.get('stations'))
+                fetched_at = cached_time(value.get('fetchedAt'))
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                print(f"Ignoring unreadable cached lineup for {country_code}: {e}")
+                continue
+            self.all_channels.update({country_code: stations})
+            self.channelsAt.update({country_code: fetched_at})
+            self.lineupVersion.update({country_code: 1})
+
+        for country_code, value in self.cache.load('timelines').items():
+            if country_code not in self.x_forward:
+                continue
+            strings = {}
+            try:
+                store = {channel_id: {row[0]: restore_programme(row, strings) for row in rows}
+                         for channel_id, rows in value.get('programmes').items()}
+                full_at = cached_time(value.get('fullAt')) if value.get('fullAt') else None
+                updated_at = cached_time(value.get('updatedAt'))
+            except (AttributeError, IndexError, KeyError, TypeError, ValueError) as e:
+                print(f"Ignoring unreadable cached timelines for {country_code}: {e}")
+                continue
+            self.timeline_store.update({country_code: store})
+            self.guide_index.update({country_code: GuideIndex(store)})
+            self.epg_horizon.update({country_code: value.get('horizon')})
+            if full_at is not None:
+                self.epg_full_at.update({country_code: full_at})
+            self.epg_updated.update({country_code: updated_at})
+            # Changes are tracked from the restored guide onwards
+            base = int(self.epg_updated.get(country_code).timestamp() * 1000)
+            self.guide_changes.update({country_code: ChangeLog(base)})
+            self.guide_version = max(self.guide_version, base)
+        restored = sorted(set(self.response_list) | set(self.all_channels) | set(self.timeline_store))
+        if restored:
+            print(f"Restored cached state for {', '.join(restored)}")
 
     def load_device(self):
         if self.device is None:
@@ -24,25 +502,88 @@ class Client:
         return(self.device)
 
     def resp_data(self, country_code):
-        desired_timezone = pytz.timezone('UTC')
-        current_date = datetime.now(desired_timezone)
-        if (self.response_list.get(country_code) is not None) and (current_date - self.sessionAt.get(country_code, datetime.now())) < timedelta(hours=4):
-            return self.response_list[country_code], None
-
-        boot_headers = {
-            'authority': 'boot.pluto.tv',
-            'accept': '*/*',
-            'accept-language': 'en-US,en;q=0.9',
-            'origin': 'https://pluto.tv',
-            'referer': 'https://pluto.tv/',
-            'sec-ch-ua': '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Linux"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-site',
-            'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-            }
+        # Boot responses are cached per country. Once a token is due for
+        # refresh, the current one keeps being served while a single
+        # background boot request replaces it; only a country that has no
+        # token yet waits for the boot call.
+        if country_code not in self.x_forward:
+            return None, f"Unsupported country code {country_code}"
+        resp = self.response_list.get(country_code)
+        if resp is not None:
+            if datetime.now(pytz.utc) >= self.token_refresh_at(country_code):
+                self.refresh_token(country_code)
+            return resp, None
+        return self.load_token(country_code)
+
+    def token_refresh_at(self, country_code):
+        # Refresh token_refresh_margin before the JWT expires, and at least
+        # every 4 hours, but never sooner than token_retry after the last boot
+        session_at = self.sessionAt.get(country_code)
+        expires = session_at + timedelta(hours=4)
+        token_exp = token_expiry(self.response_list.get(country_code, {}).get('sessionToken'))
+        if token_exp is not None:
+            expires = min(expires, token_exp)
+        return max(expires - self.token_refresh_margin, session_at + self.token_retry)
+
+    def refresh_token(self, country_code):
+        # Start a background boot request unless one is already running
+        lock = self.token_locks.setdefault(country_code, threading.Lock())
+        if not lock.locked():
+            threading.Thread(target=self.load_token, args=(country_code,), daemon=True).start()
+
+    def schedule_token_refresh(self, country_code, delay):
+        if self.refresh_countries is not None and country_code not in self.refresh_countries:
+            return
+        timer = self.token_timers.get(country_code)
+        if timer is not None:
+            timer.cancel()
+        timer = threading.Timer(max(0, delay), self.load_token, args=(country_code,))
+        timer.daemon = True
+        self.token_timers.update({country_code: timer})
+        timer.start()
+
+    def load_token(self, country_code):
+        # Single-flight boot request: concurrent callers for the same country
+        # wait for the one in flight and share its response
+        if country_code not in self.x_forward:
+            return None, f"Unsupported country code {country_code}"
+        session_at = self.sessionAt.get(country_code)
+        with self.token_locks.setdefault(country_code, threading.Lock()):
+            if self.sessionAt.get(country_code) != session_at and self.response_list.get(country_code) is not None:
+                return self.response_list.get(country_code), None
+            resp, error = self.fetch_token(country_code)
+        TOKEN_REFRESHES.inc(country=country_code, result='failed' if error else 'ok')
+
+        if error:
+            if self.response_list.get(country_code) is not None:
+                # Keep serving the current token and try again shortly
+                print(f"Token refresh for {country_code} failed, retrying in {self.token_retry.seconds}s: {error}")
+                self.schedule_token_refresh(country_code, self.token_retry.total_seconds())
+            return None, error
+
+        # Refresh proactively ahead of expiry, whether or not requests arrive
+        self.schedule_token_refresh(country_code, (self.token_refresh_at(country_code) - datetime.now(pytz.utc)).total_seconds())
+        return resp, None
+
+    def request_headers(self, kind, country_code, token = None):
+        # Prebuilt headers for 'boot' or 'service' requests from a country,
+        # rebuilt only when the bearer token changes. Callers must not modify
+        # the returned dict.
+        key = (kind, country_code)
+        cached = self.header_sets.get(key)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+        headers = dict(BOOT_HEADERS if kind == 'boot' else SERVICE_HEADERS)
+        if token is not None:
+            headers.update({'authorization': f'Bearer {token}'})
+        headers.update(self.x_forward.get(country_code, {}))
+        self.header_sets.update({key: (token, headers)})
+        return headers
+
+    def fetch_token(self, country_code):
+        current_date = datetime.now(pytz.utc)
+
+        boot_headers = self.request_headers('boot', country_code)
 
         boot_params = {
             'appName': 'web',
@@ -62,11 +603,8 @@ class Client:
             # 'clientTime': '2024-04-18T19:05:52.323Z',
             }
 
-        if country_code in self.x_forward.keys():
-            boot_headers.update(self.x_forward.get(country_code))
-
         try:
-            response = self.session.get('https://boot.pluto.tv/v4/start', headers=boot_headers, params=boot_params)
+            response = self.transport.get('https://boot.pluto.tv/v4/start', country_code, headers=boot_headers, params=boot_params)
         except Exception as e:
             return None, (f"Error Exception type: {type(e).__name__}")
 
@@ -79,14 +617,50 @@ class Client:
         # Save entire Response:
         self.response_list.update({country_code: resp})
         self.sessionAt.update({country_code: current_date})
+        if self.cache is not None:
+            self.cache.save('boot', country_code, {'resp': resp, 'sessionAt': current_date.isoformat()})
         print(f"New token for {country_code} generated at {(self.sessionAt.get(country_code)).strftime('%Y-%m-%d %H:%M.%S %z')}")
 
         return self.response_list.get(country_code), None
 
-    def channels(self, country_code):
+    def channels(self, country_code, wait = False):
+        # Lineups are cached for lineup_ttl. A stale lineup is still returned
+        # while a background refresh runs, unless wait is set (EPG builds),
+        # in which case the caller refreshes it first.
         if country_code == 'all':
             return(self.channels_all())
 
+        cached = self.all_channels.get(country_code)
+        fetched_at = self.channelsAt.get(country_code)
+        if cached is not None and fetched_at is not None:
+            if datetime.now(pytz.utc) - fetched_at < self.lineup_ttl:
+                return cached, None
+            if not wait:
+                self.refresh_channels(country_code)
+                return cached, None
+
+        station_list, error = self.load_channels(country_code)
+        if error and cached is not None:
+            print(f"Lineup refresh for {country_code} failed, using cached lineup: {error}")
+            return cached, None
+        return station_list, error
+
+    def refresh_channels(self, country_code):
+        # Start a background lineup refresh unless one is already running
+        lock = self.lineup_locks.setdefault(country_code, threading.Lock())
+        if not lock.locked():
+            threading.Thread(target=self.load_channels, args=(country_code,), daemon=True).start()
+
+    def load_channels(self, country_code):
+        # Single-flight lineup fetch: callers that arrive while a fetch for the
+        # same country is in flight wait for it and share its result.
+        fetched_at = self.channelsAt.get(country_code)
+        with self.lineup_locks.setdefault(country_code, threading.Lock()):
+            if self.channelsAt.get(country_code) != fetched_at:
+                return self.all_channels.get(country_code), None
+            return self.fetch_channels(country_code)
+
+    def fetch_channels(self, country_code):
         resp, error = self.resp_data(country_code)
         if error: return None, error
 
@@ -95,14 +669,7 @@ class Client:
 
         url = f"https://service-channels.clusters.pluto.tv/v2/guide/channels"
 
-        headers = {
-            'authority': 'service-channels.clusters.pluto.tv',
-            'accept': '*/*',
-            'accept-language': 'en-US,en;q=0.9',
-            'authorization': f'Bearer {token}',
-            'origin': 'https://pluto.tv',
-            'referer': 'https://pluto.tv/',
-            }
+        headers = self.request_headers('service', country_code, token)
 
         params = {
             'channelIds': '',
@@ -111,11 +678,8 @@ class Client:
             'sort': 'number:asc',
             }
 
-        if country_code in self.x_forward.keys():
-            headers.update(self.x_forward.get(country_code))
-
         try:
-            response = self.session.get(url, params=params, headers=headers)
+            response = self.transport.get(url, country_code, params=params, headers=headers)
         except Exception as e:
             return None, (f"Error Exception type: {type(e).__name__}")
 
@@ -127,7 +691,7 @@ class Client:
         category_url = f"https://service-channels.clusters.pluto.tv/v2/guide/categories"
 
         try:
-            response = self.session.get(category_url, params=params, headers=headers)
+            response = self.transport.get(category_url, country_code, params=params, headers=headers)
         except Exception as e:
             return None, (f"Error Exception type: {type(e).__name__}")
         
@@ -153,77 +717,93 @@ class Client:
                     'group': categories_list.get(elem.get('id')),
                     'country_code': country_code}
 
-            # Ensure number value is unique
-            number = elem.get('number')
-            existing_numbers = {channel["number"] for channel in stations}
-            while number in existing_numbers:
-                # print(f"Updating channel number for {elem.get('name')}")
-                number += 1
-
             # Filter the list to find the element with "type" equal to "colorLogoPNG"
             color_logo_png = next((image["url"] for image in elem["images"] if image["type"] == "colorLogoPNG"), None)
-            entry.update({'number': number, 'logo': color_logo_png})
+            entry.update({'number': elem.get('number'), 'logo': color_logo_png})
 
             stations.append(entry)
 
+        # Ensure number value is unique and stable across refreshes
+        numbers = self.channel_numbers.assign(country_code, [(entry['id'], entry['number']) for entry in stations])
+        for entry in stations:
+            entry.update({'number': numbers[entry['id']]})
+
         sorted_data = sorted(stations, key=lambda x: x["number"])
         # print(json.dumps(sorted_data[0], indent = 2))
 
-        self.all_channels.update({country_code: sorted_data})
-        return(sorted_data, None)
-
-    def channels_all(self):
-        all_channel_list = []
-        for key, val in self.all_channels.items():
-            all_channel_list.extend(val)
-
-        # Using a set to keep track of slugs that have been seen and filter unique ones
-        seen = set()
-        filter_key = 'id'
-        filtered_list = [d for d in all_channel_list if d[filter_key] not in seen and not seen.add(d[filter_key])]
-
+        # Only publish a new lineup version when something actually changed
+        if sorted_data != self.all_channels.get(country_code):
+            self.all_channels.update({country_code: sorted_data})
+            self.lineupVersion.update({country_code: self.lineupVersion.get(country_code, 0) + 1})
+        self.channelsAt.update({country_code: datetime.now(pytz.utc)})
+        if self.cache is not None:
+            self.cache.save('lineup', country_code, {'stations': self.all_channels.get(country_code),
+                                                     'fetchedAt': self.channelsAt.get(country_code).isoformat()})
+        return(self.all_channels.get(country_code), None)
+
+    def lineup_version(self, country_code):
+        # Changes whenever the lineup returned by channels(country_code) changes
+        if country_code == 'all':
+            return tuple(self.lineupVersion.items())
+        return self.lineupVersion.get(country_code, 0)
+
+    def channels_all(self, country_list = None):
+        # Merge every cached lineup in country_list order (the configured
+        # countries by default, then any other cached ones), keeping the first
+        # country's copy of a channel, and renumber into the per-country
+        # offset blocks. The cached per-country station dicts are copied,
+        # never modified. The result is reused until one of the country
+        # lineups changes.
+        codes = list(country_list or self.refresh_countries or [])
+        codes.extend(code for code in self.all_channels if code not in codes)
+        version = (tuple(codes), self.lineup_version('all'))
+        cached = self.all_lineup
+        if cached is not None and cached[0] == version:
+            return(cached[1], None)
 
         seen = set()
-        for elem in filtered_list:
-            # Ensure number value is unique
-            number = elem.get('number')
-            match elem.get('country_code').lower():
-                case 'ca':
-                    offset = 6000
-                    if number < offset:
-                        number += offset
-                case 'uk':
-                    offset = 7000
-                    if number < offset:
-                        number += offset
-                case 'fr':
-                    offset = 8000
-                    if number < offset:
-                        number += offset
-            while number in seen:
-                number += 1
-            seen.add(number)
-            if number != elem.get('number'):
-                elem.update({'number': number})
-
-        return(filtered_list, None)
+        filtered_list = []
+        for code in codes:
+            for elem in self.all_channels.get(code) or []:
+                if elem['id'] not in seen:
+                    seen.add(elem['id'])
+                    filtered_list.append(elem)
+
+        numbers = self.channel_numbers.assign('all', [(elem['id'], offset_number(elem.get('country_code'), elem.get('number')))
+                                                      for elem in filtered_list])
+        all_channel_list = [dict(elem, number=numbers[elem['id']]) for elem in filtered_list]
+        self.all_lineup = (version, all_channel_list)
+        return(all_channel_list, None)
 
     #########################################################################################
     # EPG Guide Data
     #########################################################################################
     def strip_illegal_characters(self, xml_string):
-        # Define a regular expression pattern to match illegal characters
-        illegal_char_pattern = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
-
-        # Replace illegal characters with an empty string
-        clean_xml_string = illegal_char_pattern.sub('', xml_string)
-
-        return clean_xml_string
+        return strip_illegal_characters(xml_string)
+
+
+    def update_epg(self, country_code, range_count = 3, incremental = None):
+        # Single-flight refresh per country: a caller that arrives while a
+        # refresh is running waits for it and uses its result, so the store
+        # and change log are only ever updated by one refresh at a time.
+        updated = self.epg_updated.get(country_code)
+        with self.epg_locks.setdefault(country_code, threading.Lock()):
+            if self.epg_updated.get(country_code) != updated:
+                return None
+            return self.refresh_epg(country_code, range_count, incremental)
+
+    def refresh_epg(self, country_code, range_count = 3, incremental = None):
+        # Refresh the stored timelines for a country and expose them in
+        # self.epg_data. A full refresh downloads range_count 12 hour windows.
+        # An incremental refresh re-fetches only the recent-changes window and
+        # the tail beyond the previous horizon, then drops ended programmes.
+        if incremental is None:
+            incremental = self.incremental_epg
+        timer = StageTimer()
 
-
-    def update_epg(self, country_code, range_count = 3):
         resp, error = self.resp_data(country_code)
         if error: return None, error
+        timer.mark('token')
 
         token = resp.get('sessionToken', None)
         if token is None: return None, error
@@ -232,320 +812,385 @@ class Client:
 
         start_datetime = datetime.now(desired_timezone)
         start_time = start_datetime.strftime("%Y-%m-%dT%H:00:00.000Z")
-        end_time = start_time
 
         url = f"https://service-channels.clusters.pluto.tv/v2/guide/timelines"
 
-        epg_headers = {
-            'authority': 'service-channels.clusters.pluto.tv',
-            'accept': '*/*',
-            'accept-language': 'en-US,en;q=0.9',
-            'authorization': f'Bearer {token}',
-            'origin': 'https://pluto.tv',
-            'referer': 'https://pluto.tv/',
-            }
-
-        epg_params = {
-            'start': start_time,
-            'channelIds': '',
-            'duration': '720',
-            }
-
-        if country_code in self.x_forward.keys():
-            epg_headers.update(self.x_forward.get(country_code))
+        epg_headers = self.request_headers('service', country_code, token)
 
-        station_list, error = self.channels(country_code)
+        station_list, error = self.channels(country_code, wait=True)
         if error: return None, error
+        timer.mark('lineup')
 
         id_values = [d['id'] for d in station_list]
-        group_size = 100
-        grouped_id_values = [id_values[i:i + group_size] for i in range(0, len(id_values), group_size)]
-        # country_data = self.epg_data.get(country_code, [])
-        country_data = []
+        # Strings shared by the programmes of this refresh
+        strings = {}
+
+        previous = self.timeline_store.get(country_code)
+        horizon = self.epg_horizon.get(country_code)
+        full_at = self.epg_full_at.get(country_code)
+
+        if (incremental and previous is not None and horizon is not None and horizon > start_time
+                and full_at is not None and start_datetime - full_at < self.epg_full_refresh):
+            # Keep the stored lineup order and forget channels that left it
+            store = {channel_id: previous.get(channel_id, {}) for channel_id in id_values}
+            new_ids = [channel_id for channel_id in id_values if channel_id not in previous]
+            known_ids = [channel_id for channel_id in id_values if channel_id in previous]
+
+            if new_ids:
+                _, error = self.fetch_epg_range(country_code, url, epg_headers, new_ids, start_time, range_count, store, strings)
+                if error: return None, error
+
+            # Programmes in the next few hours may have been rescheduled
+            recent_end = (start_datetime.replace(minute=0, second=0, microsecond=0) + timedelta(minutes=self.epg_recent_minutes)).strftime("%Y-%m-%dT%H:00:00.000Z")
+            pages, end_time, error = self.fetch_epg_window(country_code, url, epg_headers, known_ids, start_time, self.epg_recent_minutes, strings)
+            if error: return None, error
+            self.merge_timelines(store, pages, start_time, recent_end)
+
+            # Extend the horizon to where a full refresh would reach
+            target = (start_datetime.replace(minute=0, second=0, microsecond=0) + timedelta(minutes=720 * range_count)).strftime("%Y-%m-%dT%H:00:00.000Z")
+            tail_start = max(horizon, recent_end)
+            while tail_start < target:
+                duration = min(720, int((parse_pluto_time(target) - parse_pluto_time(tail_start)).total_seconds() // 60))
+                pages, end_time, error = self.fetch_epg_window(country_code, url, epg_headers, known_ids, tail_start, duration, strings)
+                if error: return None, error
+                self.merge_timelines(store, pages, tail_start, end_time)
+                if end_time <= tail_start: break
+                tail_start = end_time
+            horizon = max(horizon, tail_start)
+        else:
+            store = {channel_id: {} for channel_id in id_values}
+            failed = set()
+            horizon, error = self.fetch_epg_range(country_code, url, epg_headers, id_values, start_time, range_count, store, strings, failed)
+            if error: return None, error
+            # Channels of failed groups keep their stored programmes where
+            # nothing newer was fetched, instead of losing their schedule
+            carried = [channel_id for channel_id in id_values if channel_id in failed and previous and channel_id in previous]
+            for channel_id in carried:
+                for key, timeline in previous[channel_id].items():
+                    store[channel_id].setdefault(key, timeline)
+            if carried:
+                print(f"Kept stored {country_code} EPG data for {len(carried)} channels whose requests failed")
+            if failed:
+                # Fetch everything again next time instead of refreshing incrementally
+                self.epg_full_at.pop(country_code, None)
+            else:
+                self.epg_full_at.update({country_code: start_datetime})
+        timer.mark('timelines')
+
+        # Evict programmes that ended before the current hour
+        for timelines in store.values():
+            for key in [key for key, timeline in timelines.items() if timeline.stop <= start_time]:
+                del timelines[key]
+
+        index = GuideIndex(store)
+        previous = self.guide_index.get(country_code)
+        version = self.next_guide_version()
+        if previous is None or country_code not in self.guide_changes:
+            self.guide_changes.update({country_code: ChangeLog(version)})
+        else:
+            self.guide_changes[country_code].record(version, index_changes(previous, index, start_time))
+        timer.mark('changes')
+
+        self.timeline_store.update({country_code: store})
+        self.guide_index.update({country_code: index})
+        self.epg_horizon.update({country_code: horizon})
+        self.epg_updated.update({country_code: start_datetime})
+        self.epg_data.update({country_code: self.timeline_pages(store)})
+        if self.cache is not None:
+            full_at = self.epg_full_at.get(country_code)
+            # Programmes are saved as lists of their fields
+            programmes = {channel_id: [list(timeline) for timeline in timelines.values()] for channel_id, timelines in store.items()}
+            self.cache.save('timelines', country_code, {'programmes': programmes, 'horizon': horizon,
+                                                        'fullAt': full_at.isoformat() if full_at else None,
+                                                        'updatedAt': start_datetime.isoformat()})
+        timer.mark('store')
+        self.epg_timings.update({country_code: timer.seconds})
+        return None
 
+    def next_guide_version(self):
+        # Millisecond timestamp, strictly increasing across every country
+        with self.version_lock:
+            self.guide_version = max(int(time.time() * 1000), self.guide_version + 1)
+            return self.guide_version
+
+    def epg_changes(self, country_codes, since):
+        # Net programme changes since version (or millisecond timestamp)
+        # since, for one country or for the merged guide of country_codes.
+        # Returns {'version', 'full', 'changes'}; full means since is older
+        # than the recorded history and the whole guide has to be fetched.
+        logs = [(code, self.guide_changes.get(code)) for code in country_codes if code in self.guide_changes]
+        if not logs:
+            return None, "EPG has not been built yet"
+        version = max(log.version for _, log in logs)
+        if since is None or since < max(log.base for _, log in logs) or since > version:
+            return {'version': version, 'full': True, 'changes': []}, None
+
+        # As in the merged guide, the first country that carries a channel supplies its programmes
+        owner = {}
+        for code, _ in logs:
+            for channel_id in self.guide_index.get(code).channels:
+                owner.setdefault(channel_id, code)
+        entries = []
+        for code, log in logs:
+            entries.extend((entry_version, [change for change in changes if owner.get(change[0], code) == code])
+                           for entry_version, changes in log.since(since))
+        entries.sort(key=lambda entry: entry[0])
+        return {'version': version, 'full': False, 'changes': merge_changes(entries)}, None
+
+    def epg_changes_xml(self, changes):
+        return changes_xmltv(changes)
+
+    def epg_published(self, country_code, max_age):
+        # True when the country's guide file was written within max_age and
+        # its timelines are stored for the merged guide. The file time is
+        # used because epg.json requests refresh the timelines without
+        # publishing a new guide.
+        try:
+            published = datetime.fromtimestamp(os.path.getmtime(f"epg-{country_code}.xml"), pytz.utc)
+        except OSError:
+            return False
+        return country_code in self.timeline_store and datetime.now(pytz.utc) - published < max_age
+
+    def fetch_epg_range(self, country_code, url, headers, id_values, start_time, range_count, store, strings = None, failed = None):
+        # Fetch range_count consecutive 12 hour windows into store.
+        # Returns (end_time, error).
+        end_time = start_time
         for i in range(range_count):
-            if end_time != start_time:
-                start_time = end_time
-                epg_params.update({'start': start_time})
-            print(f'Retrieving {country_code} EPG data for {start_time}')
-
-            for group in grouped_id_values:
-                epg_params.update({"channelIds": ','.join(map(str, group))})
-                try:
-                    response = self.session.get(url, params=epg_params, headers=epg_headers)
-                except Exception as e:
-                    return None, (f"Error Exception type: {type(e).__name__}")
-                
-                if response.status_code != 200:
-                    return None, f"HTTP failure {response.status_code}: {response.text}"
-                country_data.append(response.json())
-
-
-            end_time = datetime.strptime(response.json()["meta"]["endDateTime"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:00:00.000Z")
+            pages, end_time, error = self.fetch_epg_window(country_code, url, headers, id_values, end_time, 720, strings, failed)
+            if error: return None, error
+            self.merge_timelines(store, pages)
+        return end_time, None
+
+    def fetch_epg_window(self, country_code, url, headers, id_values, start_time, duration, strings = None, failed = None):
+        # Fetch one window for the given channels, 100 channels per request.
+        # Returns (pages, end_time, error) with compact pages (see
+        # compact_page); a window only fails when every group in it failed.
+        # The channel ids of failed groups are added to the failed set.
+        group_size = 100
+        grouped_id_values = [id_values[i:i + group_size] for i in range(0, len(id_values), group_size)]
+        if not grouped_id_values:
+            return [], start_time, None
 
+        epg_params = {
+            'start': start_time,
+            'channelIds': '',
+            'duration': str(duration),
+            }
 
-        self.epg_data.update({country_code: country_data})
-        return None
+        print(f'Retrieving {country_code} EPG data for {start_time}')
+        pages = []
+        error = None
+        for group, (data, group_error) in zip(grouped_id_values, self.fetch_timelines(country_code, url, epg_params, headers, grouped_id_values, strings)):
+            if group_error:
+                print(f"Skipping {country_code} EPG group starting {group[0]}: {group_error}")
+                error = group_error
+                if failed is not None:
+                    failed.update(group)
+                continue
+            pages.append(data)
+
+        if not pages:
+            return None, None, error
+
+        end_time = parse_pluto_time(pages[-1]["meta"]["endDateTime"]).replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:00:00.000Z")
+        return pages, end_time, None
+
+    def merge_timelines(self, store, pages, replace_from = None, replace_until = None):
+        # Add fetched programmes to store ({channelId: {start: Programme}}).
+        # Stored programmes of a returned channel that start inside
+        # [replace_from, replace_until) are dropped first, so programmes that
+        # were rescheduled or removed upstream do not linger. Pluto timestamps
+        # share one fixed layout, so they compare correctly as strings.
+        for page in pages:
+            for entry in page.get("data", []):
+                timelines = store.setdefault(entry["channelId"], {})
+                if replace_from is not None:
+                    for key in [key for key in timelines if replace_from <= key < replace_until]:
+                        del timelines[key]
+                for timeline in entry.get("timelines") or []:
+                    timelines[timeline.start] = timeline
+
+    def timeline_pages(self, store):
+        # Present the store in the page layout read_epg_data expects, one
+        # entry per channel with its programmes in start order
+        return [{'data': [{'channelId': channel_id, 'timelines': [timelines[key] for key in sorted(timelines)]}
+                          for channel_id, timelines in store.items()]}]
+
+    def fetch_timelines(self, country_code, url, params, headers, grouped_id_values, strings = None):
+        # Fetch one time window for every channel group, with at most
+        # fetch_concurrency requests in flight. Results are returned in group
+        # order as (data, error) tuples so one failed group does not discard
+        # the rest of the window. Each response is compacted as soon as it
+        # is parsed, so the raw JSON is released right away.
+        if strings is None:
+            strings = {}
+
+        def fetch(group):
+            group_params = dict(params, channelIds=','.join(map(str, group)))
+            try:
+                with self.timeline_slots:
+                    response = self.transport.get(url, country_code, params=group_params, headers=headers)
+            except Exception as e:
+                return None, (f"Error Exception type: {type(e).__name__}")
+
+            if response.status_code != 200:
+                return None, f"HTTP failure {response.status_code}: {response.text}"
+            return compact_page(response.json(), strings), None
+
+        if self.fetch_concurrency == 1 or len(grouped_id_values) <= 1:
+            return [fetch(group) for group in grouped_id_values]
+
+        with ThreadPoolExecutor(max_workers=min(self.fetch_concurrency, len(grouped_id_values))) as executor:
+            return list(executor.map(fetch, grouped_id_values))
 
     def epg_json(self, country_code):
         error_code = self.update_epg(country_code)
         if error_code:
             print("error")
             return None, error_code
-        return self.epg_data, None
-
-    def find_tuples_by_value(self, dictionary, target_value):
-        result_list = []  # Initialize an empty list
-        for key, values in dictionary.items():
-            if target_value in values:
-                result_list.extend(key)  # Add the first element of the tuple to the result list
-        return result_list if result_list else [target_value]  # Return None if the value is not found in any list
-
-    def read_epg_data(self, resp, root):
-        seriesGenres = {
-            ("Animated",): ["Family Animation", "Cartoons"],
-            ("Educational",): ["Education & Guidance", "Instructional & Educational"],
-            ("News",): ["News and Information", "General News", "News + Opinion", "General News"],
-            ("History",): ["History & Social Studies"],
-            ("Politics",): ["Politics"],
-            ("Action",):
-                [
-                  "Action & Adventure",
-                  "Action Classics",
-                  "Martial Arts",
-                  "Crime Action",
-                  "Family Adventures",
-                  "Action Sci-Fi & Fantasy",
-                  "Action Thrillers",
-                  "African-American Action",
-                ],
-            ("Adventure",): ["Action & Adventure", "Adventures", "Sci-Fi Adventure"],
-            ("Reality",):
-                [
-                  "Reality",
-                  "Reality Drama",
-                  "Courtroom Reality",
-                  "Occupational Reality",
-                  "Celebrity Reality",
-                ],
-            ("Documentary",):
-                [
-                  "Documentaries",
-                  "Social & Cultural Documentaries",
-                  "Science and Nature Documentaries",
-                  "Miscellaneous Documentaries",
-                  "Crime Documentaries",
-                  "Travel & Adventure Documentaries",
-                  "Sports Documentaries",
-                  "Military Documentaries",
-                  "Political Documentaries",
-                  "Foreign Documentaries",
-                  "Religion & Mythology Documentaries",
-                  "Historical Documentaries",
-                  "Biographical Documentaries",
-                  "Faith & Spirituality Documentaries",
-                ],
-            ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
-            ("Science Fiction",): ["Sci-Fi Thrillers", "Sci-Fi Adventure", "Action Sci-Fi & Fantasy"],
-            ("Thriller",): ["Sci-Fi Thrillers", "Thrillers", "Crime Thrillers"],
-            ("Biography",): ["Biographical Documentaries", "Inspirational Biographies"],
-            ("Talk",): ["Talk & Variety", "Talk Show"],
-            ("Variety",): ["Sketch Comedies"],
-            ("Home Improvement",): ["Art & Design", "DIY & How To", "Home Improvement"],
-            ("House/garden",): ["Home & Garden"],
-            # ("Science",): ["Science and Nature Documentaries"],
-            # ("Nature",): ["Science and Nature Documentaries", "Animals"],
-            ("Cooking",): ["Cooking Instruction", "Food & Wine", "Food Stories"],
-            ("Travel",): ["Travel & Adventure Documentaries", "Travel"],
-            ("Western",): ["Westerns", "Classic Westerns"],
-            ("LGBTQ",): ["Gay & Lesbian", "Gay & Lesbian Dramas", "Gay"],
-            ("Game show",): ["Game Show"],
-            ("Military",): ["Classic War Stories"],
-            ("Comedy",):
-                [
-                  "Cult Comedies",
-                  "Spoofs and Satire",
-                  "Slapstick",
-                  "Classic Comedies",
-                  "Stand-Up",
-                  "Sports Comedies",
-                  "African-American Comedies",
-                  "Showbiz Comedies",
-                  "Sketch Comedies",
-                  "Teen Comedies",
-                  "Latino Comedies",
-                  "Family Comedies",
-                ],
-            ("Crime",): ["Crime Action", "Crime Drama", "Crime Documentaries"],
-            ("Sports",): ["Sports","Sports & Sports Highlights","Sports Documentaries", "Poker & Gambling"],
-            ("Poker & Gambling",): ["Poker & Gambling"],
-            ("Crime drama",): ["Crime Drama"],
-            ("Drama",):
-                [
-                  "Classic Dramas",
-                  "Family Drama",
-                  "Indie Drama",
-                  "Romantic Drama",
-                  "Crime Drama",
-                ],
-            ("Children",): ["Kids", "Children & Family", "Kids' TV", "Cartoons", "Animals", "Family Animation", "Ages 2-4", "Ages 11-12",],
-            ("Animated",): ["Family Animation", "Cartoons"]
-            }
+        # Programmes back in the timelines API layout
+        pages = [{'data': [{'channelId': entry['channelId'], 'timelines': [timeline_dict(timeline) for timeline in entry['timelines']]}
+                           for entry in page['data']]}
+                 for page in self.epg_data.get(country_code, [])]
+        return {country_code: pages}, None
 
-        for entry in resp["data"]:
-            for timeline in entry["timelines"]:
-                # Create programme element
-                programme = ET.SubElement(root, "programme", attrib={"channel": entry["channelId"],
-                                                                 "start": datetime.strptime(timeline["start"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z"),
-                                                                 "stop": datetime.strptime(timeline["stop"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y%m%d%H%M%S %z")})
-                # Add sub-elements to programme
-                title = ET.SubElement(programme, "title")
-                title.text = self.strip_illegal_characters(timeline["title"])
-                if timeline["episode"].get("series", {}).get("type", "") == "live":
-                    if timeline["episode"]["clip"]["originalReleaseDate"] == timeline["start"]:
-                        live = ET.SubElement(programme, "live")
-                    if timeline["episode"].get("season", None):
-                        episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
-                        episode_num_onscreen.text = f'S{timeline["episode"]["season"]:02d}E{timeline["episode"]["number"]:02d}'
-                        episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
-                        episode_num_pluto.text = timeline["episode"]["_id"]
-                elif timeline["episode"].get("series", {}).get("type", "") == "tv":
-                    episode_num_onscreen = ET.SubElement(programme, "episode-num", attrib={"system": "onscreen"})
-                    episode_num_onscreen.text = f'S{timeline["episode"]["season"]:02d}E{timeline["episode"]["number"]:02d}'
-                    episode_num_pluto = ET.SubElement(programme, "episode-num", attrib={"system": "pluto"})
-                    episode_num_pluto.text = timeline["episode"]["_id"]
-                episode_num_air_date = ET.SubElement(programme, "episode-num", attrib={"system": "original-air-date"})
-                episode_num_air_date.text = datetime.strptime(timeline["episode"]["clip"]["originalReleaseDate"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
-                desc = ET.SubElement(programme, "desc")
-                desc.text = self.strip_illegal_characters(timeline["episode"]["description"]).replace('&quot;', '"')
-                icon_programme = ET.SubElement(programme, "icon", attrib={"src": timeline["episode"]["series"]["tile"]["path"]})
-                date = ET.SubElement(programme, "date")
-                date.text = datetime.strptime(timeline["episode"]["clip"]["originalReleaseDate"], "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y%m%d")
-                # if timeline["episode"].get("series", {}).get("type", "") == "tv":
-                series_id_pluto = ET.SubElement(programme, "series-id", attrib={"system": "pluto"})
-                series_id_pluto.text = timeline["episode"]["series"]["_id"]
-                if timeline["title"].lower() != timeline["episode"]["name"].lower():
-                    sub_title = ET.SubElement(programme, "sub-title")
-                    sub_title.text = self.strip_illegal_characters(timeline["episode"]["name"])
-                categories = []
-                if timeline["episode"].get("genre", None) is not None:
-                    genre = timeline["episode"]["genre"]
-                    result = self.find_tuples_by_value(seriesGenres, genre)
-                    categories.extend(result)
-                if timeline["episode"].get("series", {}).get("type", "") == "tv":
-                    categories.append("Series")
-                if timeline["episode"].get("series", {}).get("type", "") == "film":
-                    categories.append("Movie")
-                if timeline["episode"].get("subGenre", None) is not None:
-                    subGenre = timeline["episode"]["subGenre"]
-                    result = self.find_tuples_by_value(seriesGenres, subGenre)
-                    categories.extend(result)
-                # categories = sorted(categories)
-
-                unique_list = []
-                for item in categories:
-                    if item not in unique_list:
-                        unique_list.append(item)
-
-                for category in unique_list:
-                    category_elem = ET.SubElement(programme, "category")
-                    category_elem.text = category
-        return root
-
-    def get_all_epg_data(self, country_code):
+    def genre_categories(self, genre):
+        return genre_categories(genre)
+
+    def read_epg_data(self, resp):
+        # Yield one <programme> element per timeline entry
+        return programme_elements(resp)
+
+    def get_all_epg_data(self, country_code, refresh = True):
         all_epg_data = []
         # print (country_code)
-        channelIds_seen = {}
+        # The first country that carries a channel supplies its programmes
+        channel_owner = {}
         range_count = 3
 
         for country in country_code:
-            error_code = self.update_epg(country, range_count)
-            if error_code: return error_code
+            if refresh:
+                error_code = self.update_epg(country, range_count)
+                if error_code: return error_code
+            elif country not in self.epg_data:
+                if country not in self.timeline_store:
+                    # Country has never been fetched successfully; leave it out of the merged guide
+                    print(f"[INFO] No {country} EPG data in snapshot, skipping")
+                    continue
+                self.epg_data.update({country: self.timeline_pages(self.timeline_store[country])})
 
             for epg_list in self.epg_data.get(country):
-                data_list = epg_list.get('data')
-                # Make a copy of the list for iteration to avoid modifying the list while iterating
-                for entry in data_list[:]:
-                    channelId = entry.get('channelId')
-                    if channelId in channelIds_seen:
-                        if channelIds_seen.get(channelId, 0) < range_count:
-                            channelIds_seen.update({channelId: (channelIds_seen.get(channelId, 0) + 1)})
-                            # print(f"[INFO] Adding {country}: {channelId}")
-                        else:
-                            # print(f"[INFO] Beyond {range_count}: Skipping duplicate entry for {country}: {channelId}")
-                            data_list.remove(entry)
-                    else:
-                        channelIds_seen.update({channelId: 1})
+                data_list = [entry for entry in epg_list.get('data')
+                             if channel_owner.setdefault(entry.get('channelId'), country) == country]
                 epg_data_dict = {'data': data_list}
                 all_epg_data.append(epg_data_dict)
 
-            
         # print(f"[INFO] Length {len(all_epg_data)}")
         return(all_epg_data)
 
 
-    def create_xml_file(self, country_code):
-        if isinstance(country_code, str):
-            error_code = self.update_epg(country_code)
-            if error_code: return error_code
+    def create_xml_file(self, country_code, refresh = True):
+        # Armed builds are captured with cProfile, see profiling.Profiler
+        with PROFILER.build(country_code if isinstance(country_code, str) else 'all'):
+            return self.write_xml_file(country_code, refresh)
 
-            station_list, error = self.channels(country_code)
-            if error: return None, error
+    def write_xml_file(self, country_code, refresh = True):
+        timings = {}
+        fetch_stages = None
+        if isinstance(country_code, str):
+            if refresh or country_code not in self.epg_data:
+                started = time.perf_counter()
+                error_code = self.update_epg(country_code)
+                if error_code: return error_code
+                timings.update({'fetch': time.perf_counter() - started})
+                fetch_stages = self.epg_timings.get(country_code)
+
+            # update_epg has just stored this country's lineup
+            station_list = self.all_channels.get(country_code)
+            if station_list is None:
+                station_list, error = self.channels(country_code)
+                if error: return None, error
 
             xml_file_path = f"epg-{country_code}.xml"
 
         elif isinstance(country_code, list):
             xml_file_path = f"epg-all.xml"
-            station_list, error = self.channels_all()
+            station_list, error = self.channels_all(country_code)
         else:
             print("The variable is neither a string nor a list.")
             return None
 
-        compressed_file_path = f"{xml_file_path}.gz"
-        root = ET.Element("tv", attrib={"generator-info-name": "jgomez177", "generated-ts": ""})
-
-        # Create Channel Elements from list of Stations
-        for station in station_list:
-            channel = ET.SubElement(root, "channel", attrib={"id": station["id"]})
-            display_name = ET.SubElement(channel, "display-name")
-            display_name.text = self.strip_illegal_characters(station["name"])
-            icon = ET.SubElement(channel, "icon", attrib={"src": station["logo"]})
-
         # Create Programme Elements
         if isinstance(country_code, str):
             program_data =  self.epg_data.get(country_code, [])
         else:
             # Write program_data for all countries
-            program_data = self.get_all_epg_data(country_code)
-            #print(len(program_data))
-            #for elem in program_data:
-            #    print(len(elem.get("data")))
-            #program_data = []
-        # print(f"Program data: {len(program_data)}")
-        for elem in program_data:
-            root = self.read_epg_data(elem, root)
+            started = time.perf_counter()
+            program_data = self.get_all_epg_data(country_code, refresh)
+            timings.update({'fetch' if refresh else 'merge': time.perf_counter() - started})
 
+        if self.render_pool is None:
+            stats = render_guide(xml_file_path, station_list, program_data, cooperative=True)
+        else:
+            # Only the fields the guide uses are sent to the worker
+            stations = [{"id": station["id"], "name": station["name"], "logo": station["logo"]} for station in station_list]
+            stats, error = self.render_pool.run(render_guide, os.path.abspath(xml_file_path), stations, program_data)
+            if error: return error
+
+        label = country_code if isinstance(country_code, str) else 'all'
+        timings.update(stats['seconds'])
+        for stage, seconds in timings.items():
+            EPG_BUILD_SECONDS.observe(seconds, country=label, stage=stage)
+        for file_format, size in stats['bytes'].items():
+            EPG_FILE_BYTES.set(size, country=label, format=file_format)
+        EPG_PROGRAMMES.set(stats['counts'].get('programme', 0), country=label)
+        EPG_CHANNELS.set(stats['counts'].get('channel', 0), country=label)
+        detail = f" (fetch: {format_timings(fetch_stages)})" if fetch_stages else ""
+        print(f"[TIMING] {xml_file_path}: {format_timings(timings)}{detail}; "
+              f"{stats['counts'].get('programme', 0)} programmes, {stats['bytes']['xml']} bytes ({stats['bytes']['gz']} gzipped)")
+        return None
 
-        # Create an ElementTree object
-        tree = ET.ElementTree(root)
-        ET.indent(tree, '  ')
-
-        # Create a DOCTYPE declaration
-        doctype = '<!DOCTYPE tv SYSTEM "xmltv.dtd">'
-
-        # Concatenate the XML and DOCTYPE declarations in the desired order
-        xml_declaration = '<?xml version=\'1.0\' encoding=\'utf-8\'?>'
-        output_content = xml_declaration + '\n' + doctype + '\n' + ET.tostring(root, encoding='utf-8').decode('utf-8')
-
-        # Write the concatenated content to the output file
-        with open(xml_file_path, "w", encoding='utf-8') as f:
-            f.write(output_content)
+    def set_build_state(self, country_code, state, error = None):
+        # Track guide builds for readiness reporting. "ready" stays true once
+        # a guide has been published, even while a later rebuild runs or fails.
+        entry = self.build_state.setdefault(country_code, {'state': 'pending', 'ready': False, 'updated': None, 'error': None})
+        entry.update({'state': state})
+        if state == 'ok':
+            entry.update({'ready': True, 'updated': datetime.now(pytz.utc).isoformat(), 'error': None})
+        elif state == 'failed':
+            entry.update({'error': str(error)})
+
+    def build_country_file(self, country_code, max_age = None):
+        # Refresh one country's guide. With max_age, a guide published more
+        # recently than that (e.g. by the previous run of the server) is kept.
+        if max_age is not None and self.epg_published(country_code, max_age):
+            print(f"XML File for {country_code} is up to date")
+            self.set_build_state(country_code, 'ok')
+            return None
 
-        # Compress the XML file
-        with open(xml_file_path, 'rb') as file:
-            with gzip.open(compressed_file_path, 'wb') as compressed_file:
-                compressed_file.writelines(file)
+        print(f"Initialize XML File for {country_code}")
+        self.set_build_state(country_code, 'building')
+        error = self.create_xml_file(country_code)
+        if error:
+            print(f"{error}")
+        else:
+            self.all_stale = True
+        self.set_build_state(country_code, 'failed' if error else 'ok', error)
+        return error
+
+    def build_all_file(self, country_list):
+        # Merge the stored data of every country into epg-all.xml, but only
+        # when a country guide changed since the last merge
+        if not self.all_stale and os.path.exists("epg-all.xml"):
+            self.set_build_state('all', 'ok')
+            return None
 
-        # Clear the EPG data after writing full XML File
-        self.epg_data = {}
-        return None
+        print(f"Initialize XML File for ALL")
+        self.all_stale = False
+        self.set_build_state('all', 'building')
+        error = self.create_xml_file(country_list, refresh=False)
+        if error:
+            print(f"{error}")
+            self.all_stale = True
+        self.set_build_state('all', 'failed' if error else 'ok', error)
+        return error
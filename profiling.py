@@ -0,0 +1,132 @@
+import cProfile, io, os, pstats, threading, time
+from contextlib import contextmanager
+from datetime import datetime
+
+def format_timings(seconds):
+    # {"fetch": 1.234, ...} -> "fetch 1.23s, ..."
+    return ', '.join(f"{stage} {value:.2f}s" for stage, value in seconds.items())
+
+
+class StageTimer:
+    """Splits elapsed wall time into consecutive named stages."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        # Charge the time since the previous mark to stage
+        now = time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + now - self.last
+        self.last = now
+
+
+class Profiler:
+    """Opt-in cProfile captures of guide builds and HTTP requests.
+
+    arm_build(target) profiles the next build of a guide ('us_east', 'all',
+    or '*' for whichever comes first). arm_route(rule, count) profiles the
+    next count requests to a Flask route rule and merges them into one
+    capture. Each capture is written to directory as a .prof file (load it
+    with pstats or snakeviz) and a .txt summary sorted by cumulative time.
+
+    Only one capture runs at a time; work that starts while another is
+    being profiled runs unprofiled and stays armed. Under gevent the
+    profiler sees every greenlet that runs on the hub during a capture,
+    so keep the rest of the server quiet for clean numbers.
+    """
+
+    def __init__(self, directory = "profiles"):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.active = threading.Lock()
+        self.builds = set()
+        self.routes = {}
+
+    def arm_build(self, target):
+        with self.lock:
+            self.builds.add(target)
+
+    def arm_route(self, rule, count = 10):
+        with self.lock:
+            self.routes.update({rule: {'remaining': max(1, int(count)), 'profiles': []}})
+
+    def armed(self):
+        with self.lock:
+            return {'builds': sorted(self.builds),
+                    'routes': {rule: entry['remaining'] for rule, entry in self.routes.items()}}
+
+    @contextmanager
+    def build(self, target):
+        # Profile the enclosed build if target (or '*') is armed
+        with self.lock:
+            armed = target in self.builds or '*' in self.builds
+        if not armed or not self.active.acquire(blocking=False):
+            yield
+            return
+        with self.lock:
+            self.builds.discard(target if target in self.builds else '*')
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            yield
+        finally:
+            profile.disable()
+            self.active.release()
+            self.save(f"build-{target}", [profile])
+
+    def start_request(self, rule):
+        # A started Profile if requests to rule are armed, else None
+        with self.lock:
+            if rule not in self.routes:
+                return None
+        if not self.active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish_request(self, rule, profile):
+        profile.disable()
+        self.active.release()
+        with self.lock:
+            entry = self.routes.get(rule)
+            if entry is None:
+                return
+            entry['profiles'].append(profile)
+            entry['remaining'] -= 1
+            if entry['remaining'] > 0:
+                return
+            del self.routes[rule]
+        name = rule.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'index'
+        self.save(f"route-{name}", entry['profiles'])
+
+    def save(self, name, profiles):
+        # Write <name>-<timestamp>.prof and .txt; returns the .prof file name
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        file_name = f"{name}-{stamp}.prof"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(self.directory, file_name))
+
+            summary = io.StringIO()
+            pstats.Stats(os.path.join(self.directory, file_name), stream=summary).sort_stats('cumulative').print_stats(60)
+            with open(os.path.join(self.directory, f"{name}-{stamp}.txt"), 'w', encoding='utf-8') as f:
+                f.write(summary.getvalue())
+        except (OSError, TypeError) as e:
+            print(f"Unable to save profile {name}: {e}")
+            return None
+        print(f"Profile of {name} saved to {os.path.join(self.directory, file_name)}")
+        return file_name
+
+    def files(self):
+        try:
+            return sorted(name for name in os.listdir(self.directory) if name.endswith(('.prof', '.txt')))
+        except OSError:
+            return []
+
+PROFILER = Profiler()
@@ -1,9 +1,15 @@
 from gevent.pywsgi import WSGIServer
-from flask import Flask, redirect, request, Response, send_file
-from threading import Thread
-import os, sys, importlib, schedule, time, re, uuid, unicodedata
-from urllib.parse import urlparse, urlencode, urlunparse, parse_qs
-from datetime import datetime, timedelta
+from flask import Flask, g, redirect, request, Response, send_file, send_from_directory
+import os, sys, importlib, random, re, time, uuid, unicodedata, hashlib, io, gzip
+from collections import OrderedDict
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from scheduler import Job, Scheduler
+from metrics import REGISTRY, Histogram
+from profiling import PROFILER
+from xmltv import XMLTVIndex
+from stitcher import JWT_REQUIRED_CHANNELS, STITCHER, WatchURLs
 
 # import flask module
 from gevent import monkey
@@ -24,14 +30,100 @@ if pluto_country_list:
 else:
    pluto_country_list = ['local', 'us_east', 'us_west', 'ca', 'uk']
 
+fetch_concurrency = os.environ.get("PLUTO_FETCH_CONCURRENCY")
+try:
+    fetch_concurrency = max(1, int(fetch_concurrency))
+except (TypeError, ValueError):
+    fetch_concurrency = 4
+
+# Refresh EPG incrementally instead of re-downloading every window each cycle
+epg_incremental = os.environ.get("PLUTO_EPG_INCREMENTAL", "").lower() in ("1", "true", "yes")
+
+# Seconds a channel lineup is cached before it is refreshed in the background
+lineup_ttl = os.environ.get("PLUTO_LINEUP_TTL")
+try:
+    lineup_ttl = max(0, int(lineup_ttl))
+except (TypeError, ValueError):
+    lineup_ttl = 1800
+
+# Seconds before a boot token expires at which it is refreshed in the background
+token_refresh_margin = os.environ.get("PLUTO_TOKEN_REFRESH_MARGIN")
+try:
+    token_refresh_margin = max(0, int(token_refresh_margin))
+except (TypeError, ValueError):
+    token_refresh_margin = 300
+
+# SQLite file that keeps tokens, lineups and timelines across restarts
+cache_file = os.environ.get("PLUTO_CACHE_FILE", "pluto-cache.db")
+
+# Upstream HTTP connect/read timeouts in seconds
+connect_timeout = os.environ.get("PLUTO_CONNECT_TIMEOUT")
+try:
+    connect_timeout = max(0.1, float(connect_timeout))
+except (TypeError, ValueError):
+    connect_timeout = 5
+
+read_timeout = os.environ.get("PLUTO_READ_TIMEOUT")
+try:
+    read_timeout = max(0.1, float(read_timeout))
+except (TypeError, ValueError):
+    read_timeout = 30
+
+# Retries with backoff for connection errors and 429/5xx responses
+http_retries = os.environ.get("PLUTO_HTTP_RETRIES")
+try:
+    http_retries = max(0, int(http_retries))
+except (TypeError, ValueError):
+    http_retries = 3
+
+# Worker processes for rendering guides (0 renders in the server process)
+render_processes = os.environ.get("PLUTO_RENDER_PROCESSES")
+try:
+    render_processes = max(0, int(render_processes))
+except (TypeError, ValueError):
+    render_processes = 0
+
+# Fraction of /watch redirects whose stream URL is logged (0 disables the log)
+watch_log_sample = os.environ.get("PLUTO_WATCH_LOG_SAMPLE")
+try:
+    watch_log_sample = min(1.0, max(0.0, float(watch_log_sample)))
+except (TypeError, ValueError):
+    watch_log_sample = 1.0
+
+# Profiling: PLUTO_PROFILING enables the /admin/profile endpoints, and builds
+# or a route can be armed at startup. Captures are written to PLUTO_PROFILE_DIR.
+profiling_enabled = os.environ.get("PLUTO_PROFILING", "").lower() in ("1", "true", "yes")
+PROFILER.directory = os.environ.get("PLUTO_PROFILE_DIR", "profiles")
+for target in filter(None, os.environ.get("PLUTO_PROFILE_BUILD", "").split(',')):
+    PROFILER.arm_build(target.strip())
+
+profile_requests = os.environ.get("PLUTO_PROFILE_REQUESTS")
+try:
+    profile_requests = max(1, int(profile_requests))
+except (TypeError, ValueError):
+    profile_requests = 10
+
+if os.environ.get("PLUTO_PROFILE_ROUTE"):
+    PROFILER.arm_route(os.environ.get("PLUTO_PROFILE_ROUTE"), profile_requests)
+
 ALLOWED_COUNTRY_CODES = ['local', 'us_east', 'us_west', 'ca', 'uk', 'all']
 # instance of flask application
 app = Flask(__name__)
 provider = "pluto"
 providers = {
-    provider: importlib.import_module(provider).Client(),
+    provider: importlib.import_module(provider).Client(fetch_concurrency=fetch_concurrency,
+                                                       incremental_epg=epg_incremental,
+                                                       lineup_ttl=lineup_ttl,
+                                                       token_refresh_margin=token_refresh_margin,
+                                                       cache_file=cache_file,
+                                                       connect_timeout=connect_timeout,
+                                                       read_timeout=read_timeout,
+                                                       http_retries=http_retries,
+                                                       render_processes=render_processes,
+                                                       refresh_countries=pluto_country_list),
 }
 
+@lru_cache(maxsize=4096)
 def remove_non_printable(s):
     return ''.join([char for char in s if not unicodedata.category(char).startswith('C')])
 
@@ -93,103 +185,367 @@ def index():
         ul += f"<li>INVALID COUNTRY CODE in \"{', '.join(pluto_country_list).upper()}\"</li>\n"
     return f"{url}<ul>{ul}</ul></div></section></body></html>"
 
+# Seconds clients are asked to wait while the first guides are built
+RETRY_AFTER = 30
+
+@app.get("/healthz")
+def healthz():
+    # Liveness: the server is up and answering requests
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz():
+    # Readiness: every configured guide has been published at least once
+    build_state = providers[provider].build_state
+    codes = pluto_country_list + ['all']
+    countries = {code: build_state.get(code, {'state': 'pending', 'ready': False, 'updated': None, 'error': None}) for code in codes}
+    ready = all(state.get('ready') for state in countries.values())
+    headers = {} if ready else {'Retry-After': str(RETRY_AFTER)}
+    return {"ready": ready, "countries": countries, "jobs": scheduler.status()}, (200 if ready else 503), headers
+
+HTTP_SECONDS = Histogram('pluto_http_request_seconds', "Time to handle a request, by route template",
+                         ['route', 'method', 'status'])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if request.url_rule is not None:
+        g.request_profile = PROFILER.start_request(request.url_rule.rule)
+
+@app.teardown_request
+def finish_request_profile(exc):
+    profile = g.pop('request_profile', None)
+    if profile is not None:
+        PROFILER.finish_request(request.url_rule.rule, profile)
+
+@app.after_request
+def record_request_time(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.get("/metrics")
+def metrics():
+    # Prometheus text exposition format
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.post("/admin/profile/build/<target>")
+def profile_build(target):
+    # Profile the next build of a guide ('*' for the next build of any)
+    if not profiling_enabled: return "Not found", 404
+    if target != '*' and target not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
+    PROFILER.arm_build(target)
+    return PROFILER.armed()
+
+@app.post("/admin/profile/route")
+def profile_route():
+    # Profile the next ?count= requests to the route rule given in ?rule=
+    if not profiling_enabled: return "Not found", 404
+    rule = request.args.get('rule', '')
+    if rule not in {url_rule.rule for url_rule in app.url_map.iter_rules()}:
+        return "Unknown route rule", 400
+    try:
+        count = max(1, int(request.args.get('count', profile_requests)))
+    except ValueError:
+        return "Invalid count", 400
+    PROFILER.arm_route(rule, count)
+    return PROFILER.armed()
+
+@app.get("/admin/profiles")
+def profiles():
+    if not profiling_enabled: return "Not found", 404
+    return {"armed": PROFILER.armed(), "files": PROFILER.files()}
+
+@app.get("/admin/profiles/<name>")
+def profile_file(name):
+    if not profiling_enabled: return "Not found", 404
+    return send_from_directory(os.path.abspath(PROFILER.directory), name, as_attachment=True)
+
 @app.route("/<country_code>/token")
 def token(country_code):
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
     resp, error = providers[provider].resp_data(country_code)
     if error: return f"ERROR: {error}", 400
     token = resp.get('sessionToken', None)
     return(token)
 
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+def negotiated_response(body, compressed, etag, mimetype):
+    # Send the gzip variant to clients that accept it, each with its own ETag
+    if compressed is not None and accepts_gzip():
+        response = Response(compressed, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(f"{etag}-gzip")
+    else:
+        response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
+
+# Serialized JSON responses keyed by (endpoint, provider, country_code), as
+# (data version, etag, body, gzip body). A version of None means the data has
+# no version to compare, so it is serialized again but the gzip body is
+# reused while the content is unchanged. A key of None skips the cache, for
+# responses that depend on more than the key (a channel or the query).
+json_cache = {}
+
+def json_response(key, version, data):
+    if key is None:
+        body = app.json.response(data).get_data()
+        return negotiated_response(body, gzip.compress(body, compresslevel=6) if accepts_gzip() else None,
+                                   hashlib.sha1(body).hexdigest(), app.json.mimetype)
+    cached = json_cache.get(key)
+    if cached is None or version is None or cached[0] != version:
+        body = app.json.response(data).get_data()
+        etag = hashlib.sha1(body).hexdigest()
+        if cached is not None and cached[1] == etag:
+            cached = (version, etag, cached[2], cached[3])
+        else:
+            cached = (version, etag, body, gzip.compress(body, compresslevel=6))
+        json_cache[key] = cached
+    return negotiated_response(cached[2], cached[3], cached[1], app.json.mimetype)
+
 @app.route("/<country_code>/resp")
 def resp(country_code):
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
     resp, error = providers[provider].resp_data(country_code)
     if error: return f"ERROR: {error}", 400
     # token = resp.get('sessionToken', None)
-    return(resp)
+    return json_response(('resp', provider, country_code), providers[provider].sessionAt.get(country_code), resp)
 
 @app.route("/<provider>/<country_code>/channels")
 def channels(provider, country_code):
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
     # host = request.host
+    version = providers[provider].lineup_version(country_code)
     channels, error = providers[provider].channels(country_code)
     if error: return f"ERROR: {error}", 400
-    return(channels)
+    return json_response(('channels', provider, country_code), version, channels)
 
 @app.get("/<provider>/<country_code>/epg.json")
 def epg_json(provider, country_code):
+        if country_code not in ALLOWED_COUNTRY_CODES:
+            return "Invalid county code", 400
         epg, err = providers[provider].epg_json(country_code)
         if err: return err
-        return epg.get(country_code)
+        return json_response(('epg', provider, country_code), None, epg.get(country_code))
+
+# Now/next and schedule lookups are answered from the GuideIndex built after
+# every EPG refresh and the cached lineups only; they never call upstream.
+GUIDE_HOURS = 12
+
+def guide_time(value, default):
+    # ISO 8601 (naive means UTC) or epoch seconds -> Pluto timestamp string
+    if not value:
+        moment = default
+    elif re.fullmatch(r'\d+(\.\d+)?', value):
+        moment = datetime.fromtimestamp(float(value), timezone.utc)
+    else:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+def programme_json(programme):
+    return programme._asdict() if programme is not None else None
+
+def guide_index(provider, country_code):
+    # (index, error response) for a country that has been refreshed at least once
+    if country_code not in ALLOWED_COUNTRY_CODES or country_code == 'all':
+        return None, ("Invalid county code", 400)
+    index = providers[provider].guide_index.get(country_code)
+    if index is None:
+        return None, ("EPG is being built, try again shortly", 503, {'Retry-After': str(RETRY_AFTER)})
+    return index, None
+
+@app.get("/<provider>/<country_code>/now.json")
+def now_next(provider, country_code):
+    # Current and next programme of every channel in the lineup, ?at= defaults to now
+    try:
+        at = guide_time(request.args.get('at'), datetime.now(timezone.utc))
+    except (ValueError, OverflowError, OSError):
+        return "Invalid time", 400
+
+    if country_code == 'all':
+        stations, _ = providers[provider].channels_all(pluto_country_list)
+        indexes = providers[provider].guide_index
+        if not indexes:
+            return "EPG is being built, try again shortly", 503, {'Retry-After': str(RETRY_AFTER)}
+    else:
+        index, error = guide_index(provider, country_code)
+        if error: return error
+        stations = providers[provider].all_channels.get(country_code) or []
+        indexes = {country_code: index}
+
+    channels = []
+    for station in stations:
+        index = indexes.get(station.get('country_code', country_code))
+        if index is None or station['id'] not in index:
+            continue
+        current, upcoming = index.now_next(station['id'], at)
+        channels.append({'id': station['id'], 'name': station.get('name'), 'number': station.get('number'),
+                         'now': programme_json(current), 'next': programme_json(upcoming)})
+    return json_response(('now', provider, country_code), None, {'at': at, 'channels': channels})
+
+@app.get("/<provider>/<country_code>/channels/<channel_id>/now.json")
+def channel_now_next(provider, country_code, channel_id):
+    index, error = guide_index(provider, country_code)
+    if error: return error
+    if channel_id not in index:
+        return "Unknown channel", 404
+    try:
+        at = guide_time(request.args.get('at'), datetime.now(timezone.utc))
+    except (ValueError, OverflowError, OSError):
+        return "Invalid time", 400
+    current, upcoming = index.now_next(channel_id, at)
+    return json_response(None, None,
+                         {'id': channel_id, 'at': at, 'now': programme_json(current), 'next': programme_json(upcoming)})
+
+@app.get("/<provider>/<country_code>/channels/<channel_id>/guide.json")
+def channel_guide(provider, country_code, channel_id):
+    # Programmes overlapping [?start=, ?stop=), by default the next GUIDE_HOURS hours
+    index, error = guide_index(provider, country_code)
+    if error: return error
+    if channel_id not in index:
+        return "Unknown channel", 404
+    try:
+        start = guide_time(request.args.get('start'), datetime.now(timezone.utc))
+        stop = guide_time(request.args.get('stop'), datetime.fromisoformat(start[:19]).replace(tzinfo=timezone.utc) + timedelta(hours=GUIDE_HOURS))
+    except (ValueError, OverflowError, OSError):
+        return "Invalid time", 400
+    if stop <= start:
+        return "stop must be after start", 400
+    programmes = [programme._asdict() for programme in index.schedule(channel_id, start, stop)]
+    return json_response(None, None,
+                         {'id': channel_id, 'start': start, 'stop': stop, 'programmes': programmes})
 
 @app.get("/<provider>/<country_code>/stitcher.json")
 def stitch_json(provider, country_code):
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
     resp, error= providers[provider].resp_data(country_code)
     if error: return error, 500
-    return resp
+    return json_response(('resp', provider, country_code), providers[provider].sessionAt.get(country_code), resp)
+
+# Query filters shared by the playlist and EPG routes, as comma separated lists
+STATION_FILTERS = ('group', 'exclude_group', 'channels')
+
+def station_filters():
+    # Lower-cased (group, exclude_group, channels) sets, or None when unfiltered
+    filters = tuple(frozenset(value.strip().lower() for value in request.args.get(name, '').split(',') if value.strip())
+                    for name in STATION_FILTERS)
+    return filters if any(filters) else None
+
+def station_matches(station, filters):
+    # channels= matches a channel id or slug, the group filters its group-title
+    groups, excluded, channels = filters
+    group = (station.get('group') or '').lower()
+    return ((not groups or group in groups) and group not in excluded
+            and (not channels or station.get('id', '').lower() in channels or (station.get('slug') or '').lower() in channels))
+
+def cached_variant(cache, key, version):
+    # A (version, ...) entry of an LRU cache if it is still current
+    cached = cache.get(key)
+    if cached is None or cached[0] != version:
+        return None
+    cache.move_to_end(key)
+    return cached
+
+def store_variant(cache, key, value, size):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > size:
+        cache.popitem(last=False)
+    return value
+
+PLAYLIST_HEADER = b"#EXTM3U\r\n\r\n"
+
+def render_playlist(provider, country_code, stations, channel_id_format, host):
+    # One rendered entry per station in channel number order, as (station, bytes);
+    # playlists are PLAYLIST_HEADER followed by the selected entries
+    client_id = providers[provider].load_device()
+    sid = uuid.uuid4()
+    stitcher = STITCHER
+    query = f"advertisingId=&appName=web&appVersion=unknown&appStoreUrl=&architecture=&buildVersion=&clientTime=0&deviceDNT=0&deviceId={client_id}&deviceMake=Chrome&deviceModel=web&deviceType=web&deviceVersion=unknown&includeExtendedEvents=false&sid={sid}&userId=&serverSideAds=false"
+
+    entries = []
+    for s in sorted(stations, key = lambda i: i.get('number', 0)):
+        m3u = []
+        if channel_id_format == 'id':
+            m3u.append(f"#EXTINF:-1 channel-id=\"{provider}-{s.get('id')}\"")
+        elif channel_id_format == 'slug_only':
+            m3u.append(f"#EXTINF:-1 channel-id=\"{s.get('slug')}\"")
+        else:
+            m3u.append(f"#EXTINF:-1 channel-id=\"{provider}-{s.get('slug')}\"")
+        m3u.append(f" tvg-id=\"{s.get('id')}\"")
+        if s.get('number'): m3u.append(f" tvg-chno=\"{s.get('number')}\"")
+        if s.get('group'): m3u.append(f" group-title=\"{s.get('group')}\"")
+        if s.get('logo'): m3u.append(f" tvg-logo=\"{s.get('logo')}\"")
+        if s.get('tmsid'): m3u.append(f" tvg-name=\"{s.get('tmsid')}\"")
+        if s.get('name'): m3u.append(f" tvc-guide-title=\"{s.get('name')}\"")
+        if s.get('summary'): m3u.append(f" tvc-guide-description=\"{remove_non_printable(s.get('summary'))}\"")
+        if s.get('timeShift'): m3u.append(f" tvg-shift=\"{s.get('timeShift')}\"")
+        m3u.append(f",{s.get('name') or s.get('call_sign')}\n")
+        m3u.append(f"{stitcher}/stitch/hls/channel/{s.get('id')}/master.m3u8?{query}\n\n")
+        entries.append((s, ''.join(m3u).encode('utf-8')))
+
+    return entries
+
+# Rendered playlists keyed by (provider, country_code, channel_id_format, host),
+# each stored as (lineup version, etag, body, entries). Filtered variants are
+# kept under the same key plus their station_filters(), as (lineup version,
+# etag, body, None). Least recently used entries are dropped beyond
+# PLAYLIST_CACHE_SIZE.
+PLAYLIST_CACHE_SIZE = 64
+playlist_cache = OrderedDict()
 
 @app.get("/<provider>/<country_code>/playlist.m3u")
 def playlist(provider, country_code):
-    if country_code.lower() == 'all':
-        stations, err = providers[provider].channels_all()
-    elif country_code.lower() in ALLOWED_COUNTRY_CODES:
-        stations, err = providers[provider].channels(country_code)
-    else: # country_code not in ALLOWED_COUNTRY_CODES
+    country_code = country_code.lower()
+    if country_code not in ALLOWED_COUNTRY_CODES:
         return "Invalid county code", 400
 
     host = request.host
     channel_id_format = request.args.get('channel_id_format','').lower()
-    
+
+    # Read the version first so a lineup refreshed meanwhile is re-rendered next time
+    version = providers[provider].lineup_version(country_code)
+    if country_code == 'all':
+        stations, err = providers[provider].channels_all(pluto_country_list)
+    else:
+        stations, err = providers[provider].channels(country_code)
+
     if err is not None:
         return err, 500
-    stations = sorted(stations, key = lambda i: i.get('number', 0))
-
-    client_id = providers[provider].load_device()
-    sid = uuid.uuid4()
-    stitcher = "https://cfd-v4-service-channel-stitcher-use1-1.prd.pluto.tv"
-    base_path = f"/stitch/hls/channel/{id}/master.m3u8"
-    jwt_required_list = ['625f054c5dfea70007244612', '625f04253e5f6c000708f3b7', '5421f71da6af422839419cb3']
-    params = {'advertisingId': '',
-              'appName': 'web',
-              'appVersion': 'unknown',
-              'appStoreUrl': '',
-              'architecture': '',
-              'buildVersion': '',
-              'clientTime': '0',
-              'deviceDNT': '0',
-              'deviceId': client_id,
-              'deviceMake': 'Chrome',
-              'deviceModel': 'web',
-              'deviceType': 'web',
-              'deviceVersion': 'unknown',
-              'includeExtendedEvents': 'false',
-              'sid': sid,
-              'userId': '',
-              'serverSideAds': 'false'
-    }
-    
-    m3u = "#EXTM3U\r\n\r\n"
-    for s in stations:
-        url = f"http://{host}/{provider}/{country_code}/watch/{s.get('watchId') or s.get('id')}\n\n"
 
-        if channel_id_format == 'id':
-            m3u += f"#EXTINF:-1 channel-id=\"{provider}-{s.get('id')}\""
-        elif channel_id_format == 'slug_only':
-            m3u += f"#EXTINF:-1 channel-id=\"{s.get('slug')}\""
-        else:
-            m3u += f"#EXTINF:-1 channel-id=\"{provider}-{s.get('slug')}\""
-        m3u += f" tvg-id=\"{s.get('id')}\""
-        m3u += f" tvg-chno=\"{''.join(map(str, str(s.get('number', []))))}\"" if s.get('number') else ""
-        m3u += f" group-title=\"{''.join(map(str, s.get('group', [])))}\"" if s.get('group') else ""
-        m3u += f" tvg-logo=\"{''.join(map(str, s.get('logo', [])))}\"" if s.get('logo') else ""
-        m3u += f" tvg-name=\"{''.join(map(str, s.get('tmsid', [])))}\"" if s.get('tmsid') else ""
-        m3u += f" tvc-guide-title=\"{''.join(map(str, s.get('name', [])))}\"" if s.get('name') else ""
-        m3u += f" tvc-guide-description=\"{remove_non_printable(''.join(map(str, s.get('summary', []))))}\"" if s.get('summary') else ""
-        m3u += f" tvg-shift=\"{''.join(map(str, s.get('timeShift', [])))}\"" if s.get('timeShift') else ""
-        m3u += f",{s.get('name') or s.get('call_sign')}\n"
-        m3u += f"{stitcher}/stitch/hls/channel/{s.get('id')}/master.m3u8?advertisingId=&appName=web&appVersion=unknown&appStoreUrl=&architecture=&buildVersion=&clientTime=0&deviceDNT=0&deviceId={client_id}&deviceMake=Chrome&deviceModel=web&deviceType=web&deviceVersion=unknown&includeExtendedEvents=false&sid={sid}&userId=&serverSideAds=false\n\n"
-
-
-    response = Response(m3u, content_type='audio/x-mpegurl')
-    return (response)
+    key = (provider, country_code, channel_id_format, host)
+    cached = cached_variant(playlist_cache, key, version)
+    if cached is None:
+        entries = render_playlist(provider, country_code, stations, channel_id_format, host)
+        body = PLAYLIST_HEADER + b''.join(entry for _, entry in entries)
+        cached = store_variant(playlist_cache, key, (version, hashlib.sha1(body).hexdigest(), body, entries), PLAYLIST_CACHE_SIZE)
+
+    filters = station_filters()
+    if filters is not None:
+        # Subsets are joined from the rendered entries of the full playlist
+        entries = cached[3]
+        variant = cached_variant(playlist_cache, key + (filters,), version)
+        if variant is None:
+            body = PLAYLIST_HEADER + b''.join(entry for station, entry in entries if station_matches(station, filters))
+            variant = store_variant(playlist_cache, key + (filters,), (version, hashlib.sha1(body).hexdigest(), body, None), PLAYLIST_CACHE_SIZE)
+        cached = variant
+
+    response = Response(cached[2], content_type='audio/x-mpegurl')
+    response.set_etag(cached[1])
+    return (response.make_conditional(request))
 
 @app.get("/mjh_compatible/<provider>/<country_code>/playlist.m3u")
 def playlist_mjh_compatible(provider, country_code):
@@ -201,65 +557,142 @@ def playlist_maddox_compatible(provider, country_code):
     host = request.host
     return (redirect(f"http://{host}/{provider}/{country_code}/playlist.m3u?compatibility=slug_only"))
 
+# WatchURLs by provider, rebuilt if the provider's device id changes
+watch_urls = {}
+
 @app.route("/<provider>/<country_code>/watch/<id>")
 def watch(provider, country_code, id):
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return "Invalid county code", 400
     client_id = providers[provider].load_device()
-    sid = uuid.uuid4()
-    stitcher = "https://cfd-v4-service-channel-stitcher-use1-1.prd.pluto.tv"
-    base_path = f"/stitch/hls/channel/{id}/master.m3u8"
-
-    jwt_required_list = ['625f054c5dfea70007244612', '625f04253e5f6c000708f3b7', '5421f71da6af422839419cb3']
-    
-
-    params = {'advertisingId': '',
-              'appName': 'web',
-              'appVersion': 'unknown',
-              'appStoreUrl': '',
-              'architecture': '',
-              'buildVersion': '',
-              'clientTime': '0',
-              'deviceDNT': '0',
-              'deviceId': client_id,
-              'deviceMake': 'Chrome',
-              'deviceModel': 'web',
-              'deviceType': 'web',
-              'deviceVersion': 'unknown',
-              'includeExtendedEvents': 'false',
-              'sid': sid,
-              'userId': '',
-              'serverSideAds': 'true'
-    }
-
-    if id in jwt_required_list:
+    urls = watch_urls.get(provider)
+    if urls is None or urls.device_id != client_id:
+        urls = watch_urls[provider] = WatchURLs(client_id)
+
+    if id in JWT_REQUIRED_CHANNELS:
         resp, error= providers[provider].resp_data(country_code)
         if error: return error, 500
-        # print(json.dumps(resp, indent=2))
-        token = resp.get('sessionToken','')
-        stitcherParams = resp.get("stitcherParams",'')
-        video_url = f'{stitcher}/v2{base_path}?{stitcherParams}&jwt={token}&masterJWTPassthrough=true&includeExtendedEvents=true'
+        video_url = urls.jwt_url(country_code, id, resp)
     else:
-        parsed_url = urlparse(f"{stitcher}{base_path}")
-        base_query_params = parse_qs(parsed_url.query)
-        # Update base query parameters with the provided parameters
-        for key, value in params.items():
-            if key in base_query_params:
-                # Extend the existing values with new values if the parameter already exists
-                base_query_params[key].extend(value)
-            else:
-                # Add new parameter and its values
-                base_query_params[key] = value
+        video_url = urls.channel_url(id)
 
-        # Construct updated query string
-        updated_query = urlencode(base_query_params, doseq=True)
-
-        # Generate the final URL
-        video_url = urlunparse((parsed_url.scheme, parsed_url.netloc, parsed_url.path,
-                               parsed_url.params, updated_query, parsed_url.fragment))
-
-    print(video_url)
+    if watch_log_sample and (watch_log_sample >= 1 or random.random() < watch_log_sample):
+        print(video_url)
     return (redirect(video_url))
 
 
+# Published EPG files held in memory, keyed by path, as
+# (file identity, bytes, etag, mtime). Builds replace the files with an atomic
+# rename, so a new inode or mtime means a new guide has been published.
+epg_cache = {}
+
+def published_epg(file_path):
+    with open(file_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = epg_cache.get(file_path)
+        if cached is None or cached[0] != identity:
+            data = f.read()
+            cached = (identity, data, hashlib.sha1(data).hexdigest(), stat.st_mtime)
+            epg_cache[file_path] = cached
+    return cached[1], cached[2], cached[3]
+
+# XMLTVIndex of each published guide, keyed by path, as (etag, index)
+epg_index_cache = {}
+# Filtered guides keyed by (path, station_filters(), start, stop), as
+# ((guide etag, lineup version), etag, bytes, gzip bytes); least recently
+# used entries are dropped beyond EPG_VARIANT_CACHE_SIZE
+EPG_VARIANT_CACHE_SIZE = 32
+epg_variant_cache = OrderedDict()
+MAX_EPG_HOURS = 24 * 7
+
+def filtered_epg(provider, country_code, file_path, filters, hours):
+    # A subset of the published guide joined from its per-channel fragments:
+    # channels matching filters (None keeps all) and, with hours, programmes
+    # overlapping the next hours starting at the current hour.
+    # Returns (xml, gzip xml, etag, last modified).
+    data, source_etag, last_modified = published_epg(file_path)
+    start = stop = None
+    if hours:
+        hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        start, stop = (moment.strftime("%Y%m%d%H%M%S +0000") for moment in (hour, hour + timedelta(hours=hours)))
+
+    key = (file_path, filters, start, stop)
+    version = (source_etag, providers[provider].lineup_version(country_code))
+    cached = cached_variant(epg_variant_cache, key, version)
+    if cached is None:
+        indexed = epg_index_cache.get(file_path)
+        if indexed is None or indexed[0] != source_etag:
+            indexed = (source_etag, XMLTVIndex(data))
+            epg_index_cache[file_path] = indexed
+
+        channel_ids = None
+        if filters is not None:
+            # Groups and slugs come from the cached lineup, never from upstream
+            if country_code == 'all':
+                stations, _ = providers[provider].channels_all(pluto_country_list)
+            else:
+                stations = providers[provider].all_channels.get(country_code) or []
+            channel_ids = {station['id'] for station in stations if station_matches(station, filters)}
+        body = indexed[1].subset(channel_ids, start, stop)
+        cached = store_variant(epg_variant_cache, key,
+                               (version, hashlib.sha1(body).hexdigest(), body, gzip.compress(body, compresslevel=6)),
+                               EPG_VARIANT_CACHE_SIZE)
+    return cached[2], cached[3], cached[1], last_modified
+
+def change_version(value):
+    # ?since= as a version, epoch milliseconds, ISO 8601 or an HTTP date
+    # (the Last-Modified of a downloaded guide) -> epoch milliseconds
+    if re.fullmatch(r'\d+', value):
+        return int(value)
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        moment = parsedate_to_datetime(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+def epg_changes(provider, country_code):
+    # (changes, error response) since ?since= for a country or 'all'
+    if country_code not in ALLOWED_COUNTRY_CODES:
+        return None, ("Invalid county code", 400)
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = change_version(since)
+        except (TypeError, ValueError, OverflowError):
+            return None, ("Invalid since", 400)
+    codes = pluto_country_list if country_code == 'all' else [country_code]
+    changes, error = providers[provider].epg_changes(codes, since)
+    if error: return None, (error, 503, {'Retry-After': str(RETRY_AFTER)})
+    return changes, None
+
+@app.get("/<provider>/epg/<country_code>/changes.json")
+def epg_changes_json(provider, country_code):
+    # Programmes added, changed or removed since ?since=. With "full": true the
+    # history does not reach back that far and the whole guide must be fetched.
+    changes, error = epg_changes(provider, country_code)
+    if error: return error
+    data = dict(changes, changes=[{'channel': channel_id, 'start': start, 'action': action,
+                                   'programme': programme_json(programme)}
+                                  for channel_id, start, action, programme in changes['changes']])
+    return json_response(('changes', provider, country_code), None, data)
+
+@app.get("/<provider>/epg/<country_code>/changes.xml")
+def epg_changes_xml(provider, country_code):
+    # Added and changed programmes as XMLTV; removals are only in changes.json.
+    # The version to poll with next is in the X-Guide-Version header.
+    changes, error = epg_changes(provider, country_code)
+    if error: return error
+    if changes['full']:
+        return "Changes since that version are no longer known, fetch the full guide", 410, {'X-Guide-Version': str(changes['version'])}
+    body = providers[provider].epg_changes_xml(changes['changes'])
+    response = negotiated_response(body, gzip.compress(body, compresslevel=6) if accepts_gzip() else None,
+                                   hashlib.sha1(body).hexdigest(), 'text/plain')
+    response.headers['X-Guide-Version'] = str(changes['version'])
+    return response
+
 @app.get("/<provider>/epg/<country_code>/<filename>")
 def epg_xml(provider, country_code, filename):
 
@@ -282,62 +715,113 @@ def epg_xml(provider, country_code, filename):
         # Specify the file path based on the provider and filename
         file_path = f'{filename}'
 
-        # Return the file without explicitly opening it
+        filters = station_filters()
+        hours = request.args.get('hours')
+        if hours is not None:
+            try:
+                hours = int(hours)
+            except ValueError:
+                return "Invalid hours", 400
+            if not 0 < hours <= MAX_EPG_HOURS:
+                return "Invalid hours", 400
+        if filters is not None or hours:
+            # Filter the same guide the unfiltered request would serve
+            source = filename[:-len('.gz')] if filename in ALLOWED_GZ_FILENAMES else filename
+            source_code = source[len('epg-'):-len('.xml')]
+            data, compressed, etag, last_modified = filtered_epg(provider, source_code, source, filters, hours)
+            if filename in ALLOWED_GZ_FILENAMES:
+                return send_file(io.BytesIO(compressed), as_attachment=True, download_name=file_path,
+                                 etag=etag, last_modified=last_modified)
+            if accepts_gzip():
+                response = send_file(io.BytesIO(compressed), as_attachment=False, download_name=file_path, mimetype='text/plain',
+                                     etag=f"{etag}-gzip", last_modified=last_modified)
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response = send_file(io.BytesIO(data), as_attachment=False, download_name=file_path, mimetype='text/plain',
+                                     etag=etag, last_modified=last_modified)
+            response.vary.add('Accept-Encoding')
+            return response
+
+        # Serve the published bytes from memory; send_file adds ETag,
+        # Last-Modified, Range and 304 handling
         if filename in ALLOWED_EPG_FILENAMES: 
-            return send_file(file_path, as_attachment=False, download_name=file_path, mimetype='text/plain')
+            if accepts_gzip():
+                # Hand the already compressed artifact to clients that accept it
+                try:
+                    data, etag, last_modified = published_epg(f"{file_path}.gz")
+                except FileNotFoundError:
+                    pass
+                else:
+                    response = send_file(io.BytesIO(data), as_attachment=False, download_name=file_path, mimetype='text/plain',
+                                         etag=f"{etag}-gzip", last_modified=last_modified)
+                    response.headers['Content-Encoding'] = 'gzip'
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+            data, etag, last_modified = published_epg(file_path)
+            response = send_file(io.BytesIO(data), as_attachment=False, download_name=file_path, mimetype='text/plain',
+                                 etag=etag, last_modified=last_modified)
+            response.vary.add('Accept-Encoding')
+            return response
         elif filename in ALLOWED_GZ_FILENAMES:
-            return send_file(file_path, as_attachment=True, download_name=file_path)
+            data, etag, last_modified = published_epg(file_path)
+            return send_file(io.BytesIO(data), as_attachment=True, download_name=file_path,
+                             etag=etag, last_modified=last_modified)
 
     except FileNotFoundError:
         # Handle the case where the file is not found
+        if not providers[provider].build_state.get(country_code, {}).get('ready'):
+            # The first guide for this country is still being built
+            return "EPG is being built, try again shortly", 503, {'Retry-After': str(RETRY_AFTER)}
         return "XML file not found", 404
     except Exception as e:
         # Handle other unexpected errors
         return f"An error occurred: {str(e)}", 500
 
 
-    except Exception as e:
-        # Handle other unexpected errors
-        return f"An error occurred: {str(e)}", 500
-
-
-# Define the function you want to execute every four hours
-def epg_scheduler():
-    if all(item in ALLOWED_COUNTRY_CODES for item in pluto_country_list):
-        for code in pluto_country_list:
-            # print("Scheduled EPG Data Update")
-            error = providers[provider].create_xml_file(code)
-            if error: print(f"{error}")
-        print(f"Initialize XML File for ALL")
-        error = providers[provider].create_xml_file(pluto_country_list)
-        if error: print(f"{error}")
-    
-
-# Schedule the function to run every four hours
-schedule.every(2).hours.do(epg_scheduler)
-
-# Define a function to run the scheduler in a separate thread
-def scheduler_thread():
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+# EPG refresh jobs: one per country plus one that merges epg-all.xml after a
+# country guide changes. Each country runs on its own interval with start
+# jitter and exponential backoff, so one slow or failing country doesn't
+# hold up the others.
+epg_interval = os.environ.get("PLUTO_EPG_INTERVAL")
+try:
+    epg_interval = max(60, int(epg_interval))
+except (TypeError, ValueError):
+    epg_interval = 2 * 60 * 60
+
+EPG_JITTER = 5 * 60
+EPG_START_JITTER = 10
+# Countries finishing within this many seconds share one epg-all.xml rebuild
+ALL_SETTLE = 30
+
+scheduler = Scheduler()
+
+def country_job(code):
+    def run():
+        # A guide published within half an interval (e.g. by the previous run
+        # of the server) is kept as is
+        error = providers[provider].build_country_file(code, max_age=timedelta(seconds=epg_interval / 2))
+        if not error:
+            scheduler.jobs['all'].trigger(ALL_SETTLE)
+        return error
+    return run
+
+def all_job():
+    return providers[provider].build_all_file(pluto_country_list)
+
+if all(item in ALLOWED_COUNTRY_CODES for item in pluto_country_list):
+    scheduler.add(Job('all', all_job, initial_delay=None, backoff=60, max_backoff=epg_interval))
+    for code in pluto_country_list:
+        job = scheduler.add(Job(code, country_job(code), interval=epg_interval, jitter=EPG_JITTER,
+                                initial_delay=None, backoff=60))
+        # First runs only get a small jitter so the guides are built soon after startup
+        job.trigger(random.uniform(0, EPG_START_JITTER))
 
 if __name__ == '__main__':
-    if all(item in ALLOWED_COUNTRY_CODES for item in pluto_country_list):
-        for code in pluto_country_list:
-            print(f"Initialize XML File for {code}")
-            error = providers[provider].create_xml_file(code)
-            if error: 
-                print(f"{error}")
-        print(f"Initialize XML File for ALL")
-        error = providers[provider].create_xml_file(pluto_country_list)
-        if error: print(f"{error}")
-
     sys.stdout.write(f"⇨ http server started on [::]:{port}\n")
     try:
-        # Start the scheduler thread
-        thread = Thread(target=scheduler_thread)
-        thread.start()
+        # The first run of every job builds the initial guides in the background
+        scheduler.start()
 
         WSGIServer(('', port), app, log=None).serve_forever()
     except OSError as e:
@@ -0,0 +1,81 @@
+import importlib, os, pickle, subprocess, sys, threading
+
+class RenderPool:
+    """Long-lived worker processes for CPU-bound guide rendering.
+
+    run(func, *args) calls a module-level function in an idle worker and
+    returns (result, error). At most processes calls run at once; further
+    callers wait for a free worker. Tasks and results are pickled over the
+    workers' stdin/stdout, which gevent patches to be cooperative, so the
+    server keeps handling requests while a guide renders.
+
+    Workers are plain "python -c" processes rather than multiprocessing
+    children, so they never re-import the server's __main__ module. A worker
+    that dies or is interrupted mid-task is replaced on the next call.
+    """
+
+    def __init__(self, processes):
+        self.processes = max(1, int(processes))
+        self.slots = threading.BoundedSemaphore(self.processes)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def spawn(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.Popen([sys.executable, '-c', f'import sys; sys.path.insert(0, {path!r}); import render_pool; render_pool.serve()'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, func, *args):
+        with self.slots:
+            with self.lock:
+                worker = self.idle.pop() if self.idle else None
+            if worker is None or worker.poll() is not None:
+                worker = self.spawn()
+            try:
+                pickle.dump((func.__module__, func.__name__, args), worker.stdin, pickle.HIGHEST_PROTOCOL)
+                worker.stdin.flush()
+                status, result = pickle.load(worker.stdout)
+            except (OSError, EOFError, pickle.PickleError) as e:
+                self.discard(worker)
+                return None, f"Render worker failed: {type(e).__name__}"
+            except BaseException:
+                # Interrupted mid-task; the worker's reply would be out of step
+                self.discard(worker)
+                raise
+            with self.lock:
+                self.idle.append(worker)
+
+        if status == 'error':
+            return None, result
+        return result, None
+
+    def discard(self, worker):
+        worker.kill()
+        worker.wait()
+
+    def close(self):
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.stdin.close()
+            worker.wait()
+
+
+def serve():
+    # Worker loop: read (module, function, args) tasks from stdin and reply
+    # with ('ok', result) or ('error', message) on stdout. Anything the task
+    # prints goes to stderr so it can't corrupt the replies.
+    replies = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    tasks = sys.stdin.buffer
+    while True:
+        try:
+            module, name, args = pickle.load(tasks)
+        except EOFError:
+            return
+        try:
+            reply = ('ok', getattr(importlib.import_module(module), name)(*args))
+        except Exception as e:
+            reply = ('error', f"{type(e).__name__}: {e}")
+        pickle.dump(reply, replies, pickle.HIGHEST_PROTOCOL)
+        replies.flush()
@@ -0,0 +1,113 @@
+import random, time
+import gevent
+from gevent.event import Event
+from gevent.lock import Semaphore
+
+class Job:
+    """A recurring task running in its own greenlet.
+
+    func is called with no arguments and returns an error (anything truthy)
+    or None. Successful runs are repeated every interval seconds, give or take
+    jitter. Failed runs are retried with exponential backoff starting at
+    backoff seconds and capped at max_backoff (the interval by default).
+    A job never overlaps with itself. A job with no interval only runs when
+    it is triggered.
+    """
+
+    def __init__(self, name, func, interval = None, jitter = 0, initial_delay = 0,
+                 backoff = 60, max_backoff = None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_backoff = max_backoff or interval or backoff
+        self.failures = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.running = Semaphore()
+        self.wake = Event()
+        self.due = None
+        self.greenlet = None
+        if initial_delay is not None:
+            self.trigger(initial_delay + random.uniform(0, jitter))
+
+    def trigger(self, delay = 0):
+        # Run no later than delay seconds from now; earlier requests win
+        due = time.monotonic() + max(0, delay)
+        if self.due is None or due < self.due:
+            self.due = due
+            self.wake.set()
+
+    def start(self):
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.loop)
+        return self
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def loop(self):
+        while True:
+            while True:
+                self.wake.clear()
+                remaining = None if self.due is None else self.due - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.wake.wait(remaining)
+            self.due = None
+            self.run()
+
+    def run(self):
+        if not self.running.acquire(blocking=False):
+            print(f"[{self.name}] Previous run still in progress, skipping")
+            return
+        started = time.monotonic()
+        try:
+            error = self.func()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            self.running.release()
+        self.last_run = time.time()
+        self.last_duration = time.monotonic() - started
+        self.last_error = error or None
+
+        if error:
+            self.failures += 1
+            delay = min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+            print(f"[{self.name}] Failed ({error}), retrying in {delay:.0f}s")
+        else:
+            self.failures = 0
+            delay = None if self.interval is None else self.interval + random.uniform(-self.jitter, self.jitter)
+        if delay is not None:
+            self.trigger(delay)
+
+    def status(self):
+        return {'running': self.running.locked(),
+                'failures': self.failures,
+                'last_run': self.last_run,
+                'last_duration': self.last_duration,
+                'last_error': None if self.last_error is None else str(self.last_error),
+                'next_run_in': None if self.due is None else max(0, self.due - time.monotonic())}
+
+
+class Scheduler:
+    """Named collection of Jobs that are started together."""
+
+    def __init__(self):
+        self.jobs = {}
+
+    def add(self, job):
+        self.jobs.update({job.name: job})
+        return job
+
+    def start(self):
+        for job in self.jobs.values():
+            job.start()
+
+    def status(self):
+        return {name: job.status() for name, job in self.jobs.items()}
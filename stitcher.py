@@ -0,0 +1,52 @@
+import uuid
+from urllib.parse import urlencode
+
+STITCHER = "https://cfd-v4-service-channel-stitcher-use1-1.prd.pluto.tv"
+
+# Channels that only play with the session JWT of a boot response
+JWT_REQUIRED_CHANNELS = frozenset(['625f054c5dfea70007244612', '625f04253e5f6c000708f3b7', '5421f71da6af422839419cb3'])
+
+
+class WatchURLs:
+    """Stitcher redirect URLs for the /watch route.
+
+    The query string is encoded once per device, leaving only a fresh sid
+    to fill in per request. The query of JWT channels is built once per
+    country and session token, and rebuilt when the token changes. Both URL
+    methods only format strings and look up dicts.
+    """
+
+    def __init__(self, device_id, stitcher = STITCHER):
+        self.device_id = device_id
+        self.channel_base = f"{stitcher}/stitch/hls/channel/"
+        self.jwt_base = f"{stitcher}/v2/stitch/hls/channel/"
+        before_sid = urlencode({'advertisingId': '',
+                                'appName': 'web',
+                                'appVersion': 'unknown',
+                                'appStoreUrl': '',
+                                'architecture': '',
+                                'buildVersion': '',
+                                'clientTime': '0',
+                                'deviceDNT': '0',
+                                'deviceId': device_id,
+                                'deviceMake': 'Chrome',
+                                'deviceModel': 'web',
+                                'deviceType': 'web',
+                                'deviceVersion': 'unknown',
+                                'includeExtendedEvents': 'false'})
+        after_sid = urlencode({'userId': '', 'serverSideAds': 'true'})
+        self.query_prefix = f"/master.m3u8?{before_sid}&sid="
+        self.query_suffix = f"&{after_sid}"
+        self.jwt_queries = {}
+
+    def channel_url(self, channel_id):
+        return f"{self.channel_base}{channel_id}{self.query_prefix}{uuid.uuid4()}{self.query_suffix}"
+
+    def jwt_url(self, country_code, channel_id, resp):
+        # resp is the country's current boot response
+        token = resp.get('sessionToken', '')
+        cached = self.jwt_queries.get(country_code)
+        if cached is None or cached[0] != token:
+            cached = (token, f"/master.m3u8?{resp.get('stitcherParams', '')}&jwt={token}&masterJWTPassthrough=true&includeExtendedEvents=true")
+            self.jwt_queries[country_code] = cached
+        return f"{self.jwt_base}{channel_id}{cached[1]}"
@@ -0,0 +1,80 @@
+import requests, time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import Counter, Histogram
+
+# Responses worth another attempt: rate limiting and transient server errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+UPSTREAM_SECONDS = Histogram('pluto_upstream_request_seconds', "Upstream request latency, including retries",
+                             ['endpoint', 'country'])
+UPSTREAM_ERRORS = Counter('pluto_upstream_errors_total', "Upstream requests that failed, by HTTP status or exception",
+                          ['endpoint', 'country', 'reason'])
+UPSTREAM_RETRIES = Counter('pluto_upstream_retries_total', "Upstream request attempts that were retried",
+                           ['endpoint'])
+
+def endpoint_name(url):
+    # Last path segment of a URL or request path: "start", "timelines", ...
+    return url.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+
+class CappedRetry(Retry):
+    # Honour Retry-After, but never let one response stall a build for long
+    max_retry_after = 30
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.max_retry_after)
+
+    def increment(self, method = None, url = None, *args, **kwargs):
+        # Raises once retries are used up, so only real retries are counted
+        retry = super().increment(method, url, *args, **kwargs)
+        UPSTREAM_RETRIES.inc(endpoint=endpoint_name(url or ''))
+        return retry
+
+
+class Transport:
+    """Shared HTTP transport for every Client request.
+
+    One requests.Session keeps connections alive across token, lineup and
+    timeline calls. Each host gets a connection pool of pool_maxsize, which
+    should be at least the number of concurrent fetches. Every request has
+    connect/read timeouts, and idempotent GETs are retried with exponential
+    backoff on connection errors and RETRY_STATUS responses. Once retries
+    are used up the last response is returned, so callers still see the
+    HTTP status.
+    """
+
+    def __init__(self, pool_maxsize = 10, connect_timeout = 5, read_timeout = 30, retries = 3, backoff = 0.5):
+        self.timeout = (connect_timeout, read_timeout)
+        retry = CappedRetry(total=retries,
+                            backoff_factor=backoff,
+                            status_forcelist=RETRY_STATUS,
+                            allowed_methods=frozenset(['GET']),
+                            respect_retry_after_header=True,
+                            raise_on_status=False)
+        # boot.pluto.tv and service-channels.clusters.pluto.tv, plus spares
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, country = None, **kwargs):
+        # country only labels the request metrics
+        kwargs.setdefault('timeout', self.timeout)
+        labels = {'endpoint': endpoint_name(url), 'country': country or ''}
+        started = time.perf_counter()
+        try:
+            response = self.session.get(url, **kwargs)
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(reason=type(e).__name__, **labels)
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, **labels)
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc(reason=str(response.status_code), **labels)
+        return response
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,203 @@
+import gzip, html, os, re, time
+
+XML_DECLARATION = '<?xml version=\'1.0\' encoding=\'utf-8\'?>'
+DOCTYPE = '<!DOCTYPE tv SYSTEM "xmltv.dtd">'
+
+# Start of a top-level element as written by XMLTVWriter. Text and attribute
+# values never contain a literal "<", so this cannot match inside an element.
+TOP_LEVEL_ELEMENT = re.compile(rb'\n  <(channel|programme) ')
+ATTRIBUTE = re.compile(rb' ([\w-]+)="([^"]*)"')
+
+def escape_cdata(text):
+    # Same escaping as xml.etree.ElementTree for character data
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+def escape_attrib(text):
+    # Same escaping as xml.etree.ElementTree for attribute values
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+
+class XMLTVWriter:
+    """Streams an XMLTV document one top-level element at a time.
+
+    The output is byte-identical to building the whole <tv> tree with
+    ElementTree, running ET.indent(tree, '  ') and serializing it after the
+    XML declaration and DOCTYPE, but only one <channel> or <programme> is
+    held in memory at a time. Every chunk is written to all given binary
+    file objects, so the plain and gzip files are produced in one pass.
+    """
+
+    def __init__(self, files, root_attrib, indent = '  ', buffer_size = 1 << 16):
+        self.files = files
+        self.indent = indent
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.empty = True
+        self.closed = False
+        # Seconds spent writing to each file (gzip writes include compression)
+        self.write_seconds = [0.0] * len(files)
+
+        header = f"{XML_DECLARATION}\n{DOCTYPE}\n<tv"
+        for key, value in root_attrib.items():
+            header += f' {key}="{escape_attrib(value)}"'
+        self.write(header)
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer).encode('utf-8')
+        for i, f in enumerate(self.files):
+            started = time.perf_counter()
+            f.write(data)
+            self.write_seconds[i] += time.perf_counter() - started
+        self.buffer = []
+        self.buffered = 0
+
+    def write_element(self, elem):
+        # Serialize one child of <tv> (an xml.etree.ElementTree.Element)
+        if self.empty:
+            self.write(">")
+            self.empty = False
+        parts = ["\n", self.indent]
+        self.serialize(parts.append, elem, 1)
+        self.write(''.join(parts))
+
+    def serialize(self, write, elem, level):
+        tag = elem.tag
+        write("<" + tag)
+        for key, value in elem.items():
+            write(f' {key}="{escape_attrib(value)}"')
+        if len(elem):
+            write(">")
+            child_indent = "\n" + self.indent * (level + 1)
+            for child in elem:
+                write(child_indent)
+                self.serialize(write, child, level + 1)
+            write("\n" + self.indent * level + "</" + tag + ">")
+        elif elem.text:
+            write(">" + escape_cdata(elem.text) + "</" + tag + ">")
+        else:
+            write(" />")
+
+    def close(self):
+        if self.closed:
+            return
+        self.write(" />" if self.empty else "\n</tv>")
+        self.flush()
+        self.closed = True
+
+
+def write_xmltv(xml_file_path, root_attrib, elements):
+    # Write <xml_file_path> and <xml_file_path>.gz in a single pass from an
+    # iterable of top-level elements. Both are written to temporary files and
+    # published with an atomic rename, so readers only ever see a complete
+    # guide. Returns statistics: element counts by tag, file sizes, and the
+    # seconds spent producing elements (render), serializing and writing the
+    # XML (serialize), and compressing and writing the gzip copy (compress).
+    compressed_file_path = f"{xml_file_path}.gz"
+    tmp_xml_path = f"{xml_file_path}.tmp"
+    tmp_compressed_path = f"{compressed_file_path}.tmp"
+    counts = {}
+    render = 0.0
+    try:
+        started = time.perf_counter()
+        with open(tmp_xml_path, 'wb') as xml_file, open(tmp_compressed_path, 'wb') as raw_compressed_file:
+            # Keep the original file name in the gzip header
+            with gzip.GzipFile(os.path.basename(xml_file_path), 'wb', fileobj=raw_compressed_file) as compressed_file:
+                writer = XMLTVWriter([xml_file, compressed_file], root_attrib)
+                elements = iter(elements)
+                while True:
+                    produced = time.perf_counter()
+                    elem = next(elements, None)
+                    render += time.perf_counter() - produced
+                    if elem is None:
+                        break
+                    writer.write_element(elem)
+                    counts[elem.tag] = counts.get(elem.tag, 0) + 1
+                writer.close()
+                flushed = time.perf_counter()
+            compress = writer.write_seconds[1] + time.perf_counter() - flushed
+        serialize = time.perf_counter() - started - render - compress
+        os.replace(tmp_compressed_path, compressed_file_path)
+        os.replace(tmp_xml_path, xml_file_path)
+    except BaseException:
+        for path in (tmp_xml_path, tmp_compressed_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    return {'counts': counts,
+            'bytes': {'xml': os.path.getsize(xml_file_path), 'gz': os.path.getsize(compressed_file_path)},
+            'seconds': {'render': render, 'serialize': serialize, 'compress': compress}}
+
+
+class XMLTVIndex:
+    """Per-channel fragments of a guide written by XMLTVWriter.
+
+    Splits the published bytes once into the document header, one <channel>
+    fragment per channel and the <programme> fragments of each channel, so
+    subsets can be assembled by joining fragments instead of rendering the
+    guide again. The fragments are the published bytes themselves, so a
+    subset serializes every element exactly as the full guide does.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.channels = {}
+        self.programmes = {}
+        starts = [match.start() for match in TOP_LEVEL_ELEMENT.finditer(data)]
+        end = data.rfind(b"\n</tv>")
+        if not starts or end < 0:
+            # No elements (or not an XMLTVWriter document): subsets are the whole document
+            self.header = None
+            return
+        self.header = data[:starts[0]]
+        for start, stop in zip(starts, starts[1:] + [end]):
+            fragment = data[start:stop]
+            attrib = {key.decode(): html.unescape(value.decode('utf-8'))
+                      for key, value in ATTRIBUTE.findall(fragment[:fragment.index(b">")])}
+            if fragment.startswith(b"\n  <channel"):
+                self.channels[attrib.get('id')] = fragment
+            else:
+                self.programmes.setdefault(attrib.get('channel'), []).append((attrib.get('start'), attrib.get('stop'), fragment))
+
+    def subset(self, channel_ids = None, start = None, stop = None):
+        # The guide restricted to channel_ids (None keeps every channel) and
+        # to programmes overlapping [start, stop), given as XMLTV times. The
+        # guides use +0000 throughout, so the times compare as strings.
+        if self.header is None:
+            return self.data
+        selected = [channel_id for channel_id in self.channels if channel_ids is None or channel_id in channel_ids]
+        parts = [self.header]
+        parts.extend(self.channels[channel_id] for channel_id in selected)
+        for channel_id in selected:
+            parts.extend(fragment for programme_start, programme_stop, fragment in self.programmes.get(channel_id, [])
+                         if (start is None or programme_stop > start) and (stop is None or programme_start < stop))
+        parts.append(b"\n</tv>")
+        return b''.join(parts)